@@ -4,3 +4,11 @@
 task_serializer = 'pickle'
 result_serializer = 'pickle'
 accept_content = ['pickle']
+
+# periodic tasks, which are started by running "celery beat"
+beat_schedule = {
+    'archive-old-messages': {
+        'task': 'flack.retention.archive_old_messages',
+        'schedule': 60 * 60
+    }
+}
@@ -11,8 +11,93 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get(
         'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'db.sqlite'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URI = os.environ.get('DATABASE_REPLICA_URL')
+    REPLICA_MAX_STALENESS = 5
+    REPLICA_CHECK_INTERVAL = 1
+    # "memory" keeps the users that wrote recently, which read from the
+    # primary database, in the server process, which only works with a
+    # single server process, or else the URL of a Redis server that is
+    # shared by all the servers
+    REPLICA_WRITES_BACKEND = os.environ.get('REPLICA_WRITES_BACKEND',
+                                            'memory')
+    # messages posted through Socket.IO wait in the memory of the server for
+    # up to MESSAGE_BATCH_MAX_DELAY seconds before they are sent to Celery,
+    # and are lost if the server is killed during that time
+    MESSAGE_BATCH_SIZE = 50
+    MESSAGE_BATCH_MAX_DELAY = 0.02
+    API_BATCH_MAX_MESSAGES = 100
+    PASSWORD_HASH_CONCURRENCY = 4
+    RATELIMIT_ENABLED = True
+    RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND', 'memory')
+    # number of reverse proxies in front of the application that append the
+    # client address to X-Forwarded-For, which is 1 with the nginx
+    # configuration in webserver/nginx. The per IP rate limits need this, as
+    # behind a proxy all the requests come from the address of the proxy.
+    # The header can be forged by clients, so it is only used when set.
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', '0'))
+    # token bucket limits, given as (tokens per second, burst size) for each
+    # client IP address and user token
+    RATELIMITS = {
+        'new_token': {'ip': (1, 10)},
+        'new_message': {'ip': (20, 200), 'token': (2, 20)},
+        'new_messages': {'ip': (2, 20), 'token': (0.2, 5)},
+        'post_message': {'ip': (20, 200), 'token': (2, 20)},
+    }
+    SHED_MAX_QUEUE_DEPTH = 1000
+    SHED_MAX_SQL_LATENCY = 0.5
+    SHED_CHECK_INTERVAL = 1
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_MAX_PER_PAGE = 100
+    RETENTION_MAX_AGE = 30 * 24 * 60 * 60
+    RETENTION_BATCH_SIZE = 500
+    RETENTION_MAX_BATCHES = 100
+    SQLITE_PRAGMAS = {}
+    SQLITE_WRITER = False
+    SQLITE_WRITER_BATCH_SIZE = 100
+    SQLITE_WRITER_MAX_DELAY = 0.005
     REQUEST_STATS_WINDOW = 15
+    STATS_ENABLED = True
+    TRACE_SINK = os.environ.get('TRACE_SINK')
+    JSON_STREAM_CHUNK_SIZE = 100
+    COMPRESS_RESPONSES = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI = True
+    # number of users and messages whose serialized representations are
+    # kept in memory, or 0 to disable the cache
+    OBJECT_CACHE_SIZE = 10000
+    # send updated_model events encoded with msgpack to the clients that ask
+    # for it, which requires the msgpack package
+    SOCKETIO_MSGPACK = False
+    # size of the thread pool that runs the Flask routes and the Socket.IO
+    # event handlers when the application is served by flack.asgi
+    ASYNCIO_THREADS = 32
+    # "memory" counts the Socket.IO connections of each user in the server
+    # process, which only works with a single server process, or else the
+    # URL of a Redis server that is shared by all the servers
+    PRESENCE_BACKEND = os.environ.get('PRESENCE_BACKEND', 'memory')
+    # seconds after the last connection of a user closes until the user is
+    # marked offline, which must be less than PRESENCE_TTL
+    PRESENCE_GRACE_PERIOD = 10
+    # seconds after the last event of a connection until it is no longer
+    # counted, which must be longer than the interval of the client pings
+    PRESENCE_TTL = 90
     CELERY_CONFIG = {}
+    # "celery" runs background tasks in Celery workers, and "local" in a
+    # pool of threads of the server process, which needs no broker. With
+    # "local" the task results are only kept by the process that ran them,
+    # so the server must run a single worker process
+    TASK_BACKEND = os.environ.get('TASK_BACKEND', 'celery')
+    TASK_THREADS = 4
+    TASK_MAX_QUEUE = 100
+    TASK_RESULT_TTL = 300
+    TASK_DRAIN_TIMEOUT = 30
+    # async mode of the Socket.IO server, which is detected when not set.
+    # eventlet is detected first when it is installed, so uWSGI with gevent
+    # needs "gevent_uwsgi" here
+    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE')
+    # a "unix:///path/to/directory" URL selects the local message queue in
+    # flack/pubsub.py, for deployments where all processes run on one host
     SOCKETIO_MESSAGE_QUEUE = os.environ.get(
         'SOCKETIO_MESSAGE_QUEUE', os.environ.get('CELERY_BROKER_URL',
                                                  'redis://'))
@@ -23,7 +108,18 @@ class DevelopmentConfig(Config):
 
 
 class ProductionConfig(Config):
-    pass
+    # These only apply when the database is SQLite. WAL mode allows reads to
+    # run concurrently with a write, and the serialized writer groups the
+    # frequent small updates into fewer transactions.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY'
+    }
+    SQLITE_WRITER = True
 
 
 class TestingConfig(Config):
@@ -31,10 +127,30 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     CELERY_CONFIG = {'CELERY_ALWAYS_EAGER': True}
     SOCKETIO_MESSAGE_QUEUE = None
+    MESSAGE_BATCH_MAX_DELAY = 0
+    SHED_MAX_QUEUE_DEPTH = None
+    PRESENCE_GRACE_PERIOD = 0
+
+
+class BenchmarkConfig(Config):
+    # TESTING prevents the background thread that finds offline users from
+    # being started, as it would interfere with the measurements
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(basedir,
+                                                          'bench.sqlite'))
+    CELERY_CONFIG = {'CELERY_ALWAYS_EAGER': True}
+    SOCKETIO_MESSAGE_QUEUE = None
+    MESSAGE_BATCH_MAX_DELAY = 0
+    RATELIMIT_ENABLED = False
+    # users are marked offline on disconnect, instead of by timers that
+    # would fire after the benchmark has dropped its tables
+    PRESENCE_GRACE_PERIOD = 0
 
 
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
-    'testing': TestingConfig
+    'testing': TestingConfig,
+    'benchmark': BenchmarkConfig
 }
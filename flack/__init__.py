@@ -14,17 +14,16 @@ bootstrap = Bootstrap()
 socketio = SocketIO()
 celery = Celery(__name__,
                 broker=os.environ.get('CELERY_BROKER_URL', 'redis://'),
-                backend=os.environ.get('CELERY_BROKER_URL', 'redis://'))
+                backend=os.environ.get('CELERY_BROKER_URL', 'redis://'),
+                include=['flack.tasks', 'flack.events', 'flack.retention'])
 celery.config_from_object('celeryconfig')
 
 # Import models so that they are registered with SQLAlchemy
 from . import models  # noqa
 
-# Import celery task so that it is registered with the Celery workers
-from .tasks import run_flask_request  # noqa
-
-# Import Socket.IO events so that they are registered with Flask-SocketIO
-from . import events  # noqa
+# The Celery tasks and the Socket.IO events are imported by create_app(), so
+# that scripts that only need the models do not load them. Celery workers
+# import them through the "include" option given above.
 
 
 def create_app(config_name=None, main=True):
@@ -33,23 +32,37 @@ def create_app(config_name=None, main=True):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
 
+    # Register Celery tasks, Socket.IO event handlers and the database
+    # events that maintain the search index and the object cache
+    from . import tasks, events, search, retention, cache  # noqa
+
     # Initialize flask extensions
+    from . import replica
+    replica.init_app(app)
     db.init_app(app)
+    from . import sqlite
+    sqlite.init_app(app)
     bootstrap.init_app(app)
+    queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    queue_options = {'message_queue': queue}
+    if queue and queue.startswith('unix://'):
+        # The local message queue is not known to Flask-SocketIO, so its
+        # client manager is given directly
+        from .pubsub import UnixSocketManager
+        queue_options = {'client_manager': UnixSocketManager(
+            queue, channel='flask-socketio', write_only=not main)}
     if main:
         # Initialize socketio server and attach it to the message queue, so
         # that everything works even when there are multiple servers or
         # additional processes such as Celery workers wanting to access
         # Socket.IO
-        socketio.init_app(app,
-                          message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+        socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                          **queue_options)
     else:
         # Initialize socketio to emit events through through the message queue
         # Note that since Celery does not use eventlet, we have to be explicit
         # in setting the async mode to not use it.
-        socketio.init_app(None,
-                          message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
-                          async_mode='threading')
+        socketio.init_app(None, async_mode='threading', **queue_options)
     celery.conf.update(config[config_name].CELERY_CONFIG)
 
     # Register web application routes
@@ -64,4 +77,16 @@ def create_app(config_name=None, main=True):
     from .tasks import tasks_bp as tasks_blueprint
     app.register_blueprint(tasks_blueprint, url_prefix='/tasks')
 
+    # Compress responses for clients that accept it
+    from .compress import compress_response
+    app.after_request(compress_response)
+
+    if app.config['PROXY_FIX_X_FOR']:
+        # Take the client address from the X-Forwarded-For header set by the
+        # trusted proxies. This wraps the Socket.IO middleware, so that the
+        # Socket.IO events also see the client address.
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['PROXY_FIX_X_FOR'])
+
     return app
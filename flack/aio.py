@@ -0,0 +1,273 @@
+"""Support for running the application on an asyncio event loop, without
+monkey patching the standard library.
+
+The Socket.IO connections are handled by the asyncio server of
+python-socketio. The rest of the application is regular blocking code: the
+Flask routes, the Socket.IO event handlers in events.py, and the database
+queries, password hashing, markdown rendering and link scraping that they
+do. All of it runs in a pool of threads, so the event loop is never blocked
+by it, and the number of threads gives a fixed bound on how much of this
+work runs at the same time.
+
+This mode requires Python 3.5 or newer, and an ASGI web server such as
+uvicorn.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+
+import flask
+import socketio
+
+from . import events, socketio as socketio_ext
+
+# Socket.IO event handlers from events.py that run in the thread pool, in
+# addition to connect and disconnect
+EVENT_HANDLERS = {
+    'ping_user': events.on_ping_user,
+    'post_message': events.on_post_message,
+}
+
+
+class ThreadEmitter(object):
+    """Replacement for the Socket.IO server of the Flask-SocketIO extension,
+    used when the server is an asyncio server. The code that runs in the
+    thread pool emits through this object, which hands the emits over to
+    the event loop and waits for them to be sent.
+    """
+    def __init__(self, server, timeout=10):
+        self.server = server
+        self.timeout = timeout
+        self.loop = None
+
+    def run(self, coro):
+        if self.loop is None:
+            coro.close()
+            raise RuntimeError('The event loop has not started yet')
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(self.timeout)
+
+    def emit(self, event, data=None, namespace=None, room=None,
+             skip_sid=None, callback=None, **kwargs):
+        return self.run(self.server.emit(
+            event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+            callback=callback))
+
+    def send(self, data, namespace=None, room=None, skip_sid=None,
+             callback=None, **kwargs):
+        return self.run(self.server.send(
+            data, namespace=namespace, room=room, skip_sid=skip_sid,
+            callback=callback))
+
+    def enter_room(self, sid, room, namespace=None):
+        self.loop.call_soon_threadsafe(self.server.enter_room, sid, room,
+                                       namespace)
+
+    def leave_room(self, sid, room, namespace=None):
+        self.loop.call_soon_threadsafe(self.server.leave_room, sid, room,
+                                       namespace)
+
+    def close_room(self, room, namespace=None):
+        return self.run(self.server.close_room(room, namespace=namespace))
+
+
+class WSGIApp(object):
+    """ASGI application that serves a WSGI application, running it in a
+    thread pool.
+    """
+    def __init__(self, app, executor):
+        self.app = app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope type ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            event = await receive()
+            body.append(event.get('body', b''))
+            more_body = event.get('more_body', False)
+        environ = self.get_environ(scope, b''.join(body))
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        def start():
+            iterable = self.app(environ, start_response)
+            return iterable, iter(iterable)
+
+        def next_chunk(chunks):
+            return next(chunks, None)
+
+        loop = asyncio.get_event_loop()
+        iterable, chunks = await loop.run_in_executor(self.executor, start)
+        try:
+            started = False
+            while True:
+                # the chunks of streamed responses are generated by the
+                # application as they are iterated, so each one is obtained
+                # in the thread pool
+                chunk = await loop.run_in_executor(self.executor, next_chunk,
+                                                   chunks)
+                if chunk is None:
+                    break
+                if not started:
+                    await self.start_response(send, *response)
+                    started = True
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            if not started:
+                await self.start_response(send, *response)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    @staticmethod
+    async def start_response(send, status, headers):
+        await send({'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers]})
+
+    @staticmethod
+    def get_environ(scope, body):
+        """Return the WSGI environment of an ASGI HTTP request."""
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode(
+                'utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+
+        # the body was read in full, which also covers chunked requests
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
+
+def get_client_manager(url):
+    """Return the client manager of the asyncio Socket.IO server, which is
+    attached to the same message queue as the other servers and the Celery
+    workers.
+    """
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://')):
+        # the channel is the one used by Flask-SocketIO
+        return socketio.AsyncRedisManager(url, channel='flask-socketio')
+    raise ValueError('The asyncio server requires a Redis message queue')
+
+
+class ASGIApp(socketio.ASGIApp):
+    """ASGI application that serves the Socket.IO connections with an
+    asyncio server, and everything else with the Flask application.
+    """
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            threads or app.config['ASYNCIO_THREADS'])
+        self.sio = socketio.AsyncServer(
+            async_mode='asgi', client_manager=get_client_manager(
+                app.config['SOCKETIO_MESSAGE_QUEUE']))
+        self.sessions = {}
+        self.sio.on('connect', self.on_connect)
+        self.sio.on('disconnect', self.on_disconnect)
+        for event, handler in EVENT_HANDLERS.items():
+            self.sio.on(event, self.event_handler(handler))
+
+        # emits from the Flask side are sent by the asyncio server
+        self.emitter = ThreadEmitter(self.sio)
+        socketio_ext.server = self.emitter
+        app.extensions['socketio'] = socketio_ext
+
+        super(ASGIApp, self).__init__(
+            self.sio, other_asgi_app=WSGIApp(app, self.executor))
+
+    async def __call__(self, scope, receive, send):
+        if self.emitter.loop is None:
+            self.emitter.loop = asyncio.get_event_loop()
+        await super(ASGIApp, self).__call__(scope, receive, send)
+
+    async def on_connect(self, sid, environ):
+        # as with Flask-SocketIO, the socket starts with a copy of the Flask
+        # session of the connection request
+        self.sessions[sid] = {}
+        return await self.call(sid, events.on_connect, copy_session=True)
+
+    async def on_disconnect(self, sid):
+        try:
+            return await self.call(sid, events.on_disconnect)
+        finally:
+            self.sessions.pop(sid, None)
+
+    def event_handler(self, handler):
+        async def wrapped(sid, *args):
+            return await self.call(sid, handler, *args)
+        return wrapped
+
+    async def call(self, sid, handler, *args, **kwargs):
+        """Run a Socket.IO event handler from events.py in the thread pool,
+        with a request context and the Flask session of the socket.
+        """
+        if self.emitter.loop is None:
+            self.emitter.loop = asyncio.get_event_loop()
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.run_handler, self.sio.environ[sid], sid,
+            self.sessions.setdefault(sid, {}), handler, args,
+            kwargs.get('copy_session', False))
+
+    def run_handler(self, environ, sid, session, handler, args,
+                    copy_session=False):
+        with self.app.request_context(environ):
+            flask.request.sid = sid
+            flask.request.namespace = '/'
+            if not copy_session:
+                flask.session.clear()
+                flask.session.update(session)
+            try:
+                return handler(*args)
+            finally:
+                session.clear()
+                session.update(flask.session)
@@ -1,15 +1,19 @@
-from flask import request, abort, jsonify, g
+from functools import partial
 
-from .. import db
+from flask import current_app, request, abort, jsonify, g
+
+from .. import db, cache, ratelimit, replica, retention, search
 from ..auth import token_auth, token_optional_auth
 from ..models import Message
-from ..utils import timestamp, url_for
+from ..utils import timestamp, url_for, jsonify_stream, string_types
 from ..tasks import async_task
 from . import api
 
 
 @api.route('/messages', methods=['POST'])
+@ratelimit.limit('new_message')
 @token_auth.login_required
+@ratelimit.limit_token('new_message')
 @async_task
 def new_message():
     """
@@ -19,12 +23,58 @@ def new_message():
     msg = Message.create(request.get_json() or {})
     db.session.add(msg)
     db.session.commit()
-    r = jsonify(msg.to_dict())
+    r = cache.jsonify_model(Message, msg)
     r.status_code = 201
     r.headers['Location'] = url_for('api.get_message', id=msg.id)
     return r
 
 
+@api.route('/messages/batch', methods=['POST'])
+@ratelimit.limit('new_messages')
+@token_auth.login_required
+@ratelimit.limit_token('new_messages')
+@async_task
+def new_messages():
+    """
+    Post a batch of messages.
+    This endpoint is requires a valid user token.
+    The request body is a list of messages. The valid messages are written
+    in a single transaction, and then their links are expanded, also with a
+    single commit. The response has a result for each message, in the order
+    they were given.
+    """
+    data = request.get_json()
+    if not isinstance(data, list) or not data or \
+            len(data) > current_app.config['API_BATCH_MAX_MESSAGES']:
+        abort(400)
+    msgs = [Message.create(item, expand_links=False)
+            if isinstance(item, dict) and isinstance(item.get('source'),
+                                                     string_types)
+            else None for item in data]
+    valid = [msg for msg in msgs if msg is not None]
+    if valid:
+        db.session.add_all(valid)
+        db.session.flush()
+        ids = [msg.id for msg in valid]
+        db.session.commit()
+
+        # reload the messages with a single query, since the commit expired
+        # them, and expand their links
+        Message.query.filter(Message.id.in_(ids)).all()
+        if [msg for msg in valid if msg.expand_links()]:
+            db.session.commit()
+            Message.query.filter(Message.id.in_(ids)).all()
+
+    results = []
+    for msg in msgs:
+        if msg is None:
+            results.append({'status': 400})
+        else:
+            results.append({'status': 201,
+                            'message': cache.to_dict(Message, msg)})
+    return jsonify({'results': results})
+
+
 @api.route('/messages', methods=['GET'])
 @token_optional_auth.login_required
 def get_messages():
@@ -38,12 +88,45 @@ def get_messages():
     if since < day_ago:
         # do not return more than a day worth of messages
         since = day_ago
-    msgs = Message.query.filter(Message.updated_at > since).order_by(
-        Message.updated_at)
-    return jsonify({'messages': [msg.to_dict() for msg in msgs.all()]})
+    # stream_results gives a server-side cursor on the databases that
+    # support it, so that the driver does not load all the rows at once
+    msgs = Message.select().where(Message.updated_at > since).order_by(
+        Message.updated_at).execution_options(stream_results=True)
+    return jsonify_stream('messages', db.session.execute(
+        msgs, bind=replica.read_bind()), partial(cache.to_json, Message),
+        encoded=True)
+
+
+@api.route('/messages/search', methods=['GET'])
+@token_optional_auth.login_required
+def search_messages():
+    """
+    Search messages.
+    This endpoint is publicly available, but if the client has a token it
+    should send it, as that indicates to the server that the user is online.
+    The words given in the "q" argument must all appear in the messages that
+    are returned, which are sorted by relevance and paged with the "page"
+    and "per_page" arguments.
+    """
+    query = request.args.get('q', '')
+    try:
+        page = int(request.args.get('page', '1'))
+        per_page = int(request.args.get('per_page', '20'))
+    except ValueError:
+        abort(400)
+    if not query.strip() or page < 1 or per_page < 1 or \
+            per_page > current_app.config['SEARCH_MAX_PER_PAGE']:
+        abort(400)
+    msgs = search.search(query, per_page, offset=(page - 1) * per_page,
+                         bind=replica.read_bind())
+    r = {'messages': [cache.to_dict(Message, msg) for msg in msgs]}
+    if len(msgs) == per_page:
+        r['_links'] = {'next': url_for('api.search_messages', q=query,
+                                       page=page + 1, per_page=per_page)}
+    return jsonify(r)
 
 
-@api.route('/messages/<id>', methods=['GET'])
+@api.route('/messages/<int:id>', methods=['GET'])
 @token_optional_auth.login_required
 def get_message(id):
     """
@@ -51,7 +134,18 @@ def get_message(id):
     This endpoint is publicly available, but if the client has a token it
     should send it, as that indicates to the server that the user is online.
     """
-    return jsonify(Message.query.get_or_404(id).to_dict())
+    bind = replica.read_bind()
+    msg = db.session.execute(Message.select().where(Message.id == id),
+                             bind=bind).first()
+    if msg is None:
+        # old messages are moved to the archive by the retention job
+        msg = retention.get_archived_message(id, bind=bind)
+        if msg is None:
+            abort(404)
+        # archived messages do not change, and are rarely read, so they
+        # are not cached
+        return jsonify(Message.row_to_dict(msg))
+    return cache.jsonify_model(Message, msg)
 
 
 @api.route('/messages/<id>', methods=['PUT'])
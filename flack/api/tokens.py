@@ -1,12 +1,13 @@
 from flask import jsonify, g
 
-from .. import db
+from .. import db, ratelimit
 from ..auth import basic_auth, token_auth
 
 from . import api
 
 
 @api.route('/tokens', methods=['POST'])
+@ratelimit.limit('new_token')
 @basic_auth.login_required
 def new_token():
     """
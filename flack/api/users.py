@@ -1,9 +1,11 @@
-from flask import request, abort, jsonify, g
+from functools import partial
 
-from .. import db
+from flask import request, abort, g
+
+from .. import db, replica, cache
 from ..auth import token_auth, token_optional_auth
 from ..models import User
-from ..utils import url_for
+from ..utils import url_for, jsonify_stream
 
 from . import api
 
@@ -19,7 +21,10 @@ def new_user():
         abort(400)
     db.session.add(user)
     db.session.commit()
-    r = jsonify(user.to_dict())
+    # there is no current user yet, so the write is recorded for the new
+    # one, whose next requests then read their own registration
+    replica.mark_write(user)
+    r = cache.jsonify_model(User, user)
     r.status_code = 201
     r.headers['Location'] = url_for('api.get_user', id=user.id)
     return r
@@ -33,16 +38,22 @@ def get_users():
     This endpoint is publicly available, but if the client has a token it
     should send it, as that indicates to the server that the user is online.
     """
-    users = User.query.order_by(User.updated_at.asc(), User.nickname.asc())
+    # stream_results gives a server-side cursor on the databases that
+    # support it, so that the driver does not load all the rows at once
+    users = User.select().order_by(
+        User.updated_at.asc(), User.nickname.asc()).execution_options(
+        stream_results=True)
     if request.args.get('online'):
-        users = users.filter_by(online=(request.args.get('online') != '0'))
+        users = users.where(User.online == (request.args.get('online') != '0'))
     if request.args.get('updated_since'):
-        users = users.filter(
+        users = users.where(
             User.updated_at > int(request.args.get('updated_since')))
-    return jsonify({'users': [user.to_dict() for user in users.all()]})
+    return jsonify_stream('users', db.session.execute(
+        users, bind=replica.read_bind()), partial(cache.to_json, User),
+        encoded=True)
 
 
-@api.route('/users/<id>', methods=['GET'])
+@api.route('/users/<int:id>', methods=['GET'])
 @token_optional_auth.login_required
 def get_user(id):
     """
@@ -50,7 +61,11 @@ def get_user(id):
     This endpoint is publicly available, but if the client has a token it
     should send it, as that indicates to the server that the user is online.
     """
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = db.session.execute(User.select().where(User.id == id),
+                              bind=replica.read_bind()).first()
+    if user is None:
+        abort(404)
+    return cache.jsonify_model(User, user)
 
 
 @api.route('/users/<id>', methods=['PUT'])
@@ -0,0 +1,8 @@
+from flack.aio import ASGIApp
+from flack.wsgi_aux import app as flask_app
+
+# Create an application instance that ASGI web servers can use. The Flask
+# application is the one created for auxiliary processes, which does not
+# have its own Socket.IO server, since the asyncio server of the ASGI
+# application replaces it.
+application = app = ASGIApp(flask_app)
@@ -1,7 +1,7 @@
-from flask import g, jsonify, session
+from flask import g, jsonify
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 
-from . import db
+from . import sqlite
 from .models import User
 
 
@@ -23,8 +23,7 @@ def verify_password(nickname, password):
     if user.ping():
         from .events import push_model
         push_model(user)
-    db.session.add(user)
-    db.session.commit()
+    sqlite.save(user, 'last_seen_at', 'online')
     g.current_user = user
     return True
 
@@ -38,23 +37,16 @@ def password_error():
 
 
 @token_auth.verify_token
-def verify_token(token, add_to_session=False):
+def verify_token(token):
     """Token verification callback."""
-    if add_to_session:
-        # clear the session in case auth fails
-        if 'nickname' in session:
-            del session['nickname']
     user = User.query.filter_by(token=token).first()
     if user is None:
         return False
     if user.ping():
         from .events import push_model
         push_model(user)
-    db.session.add(user)
-    db.session.commit()
+    sqlite.save(user, 'last_seen_at', 'online')
     g.current_user = user
-    if add_to_session:
-        session['nickname'] = user.nickname
     return True
 
 
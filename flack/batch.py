@@ -0,0 +1,99 @@
+import atexit
+import logging
+import os
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Batcher(object):
+    """Collect items added from any thread and hand them over in batches.
+
+    A background thread waits for an item, then keeps collecting more for up
+    to max_delay seconds or until max_size items are collected, and passes
+    the batch to the flush function. The delay added to any item is
+    therefore bounded by max_delay plus the time it takes to flush the
+    previous batch.
+
+    The items that are waiting for their batch only exist in the memory of
+    the process. They are flushed when the process exits normally, but those
+    added in the last max_delay seconds are lost if the process is killed or
+    crashes.
+    """
+    # marker that tells the background thread to flush what it has and exit
+    stop_marker = object()
+
+    def __init__(self, flush, max_size=100, max_delay=0.005,
+                 drain_timeout=30):
+        self.flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.drain_timeout = drain_timeout
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        """Add an item to the next batch."""
+        self.start()
+        self.queue.put(item)
+
+    def start(self):
+        """Start the background thread, if it isn't running in this
+        process.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # a thread started before a fork does not exist in the child
+                # process, so a new one is started there
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+                atexit.register(self.shutdown, self.drain_timeout)
+
+    def shutdown(self, timeout=None):
+        """Flush the items that are waiting for their batch, and wait for up
+        to timeout seconds for the background thread to exit.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.pid = None
+            thread = self.thread
+            self.queue.put(self.stop_marker)
+        thread.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self.stop_marker:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self.stop_marker:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self.flush(batch)
+            except Exception:
+                logger.exception('Could not flush batch')
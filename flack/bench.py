@@ -0,0 +1,312 @@
+"""Load generation benchmark.
+
+This module simulates a number of users that register, obtain tokens, post
+messages over REST and Socket.IO, send heartbeats and poll the user and
+message lists, all in the local process with the Flask and Socket.IO test
+clients. Each user runs in its own thread, so the requests of the different
+users run concurrently. It is meant to be used with the "benchmark"
+configuration, which runs Celery tasks eagerly and does not need Redis, so
+that the results of different releases can be compared.
+
+The benchmark deletes all the tables of the database before and after it
+runs, so by default it refuses to run on anything other than an in-memory
+SQLite database or a SQLite file whose name starts with "bench".
+"""
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+
+from . import db, socketio
+
+
+# Code that measures the startup of a web server or Celery worker process. It
+# runs in a fresh interpreter, so that nothing is imported in advance.
+STARTUP_SCRIPT = '''
+import json, os, resource, sys, time
+start = time.time()
+if sys.argv[1] == 'web':
+    from flack import create_app
+    app = create_app()
+else:
+    from flack import celery
+    celery.loader.import_default_modules()
+    from flack.wsgi_aux import app
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss //= 1024
+print(json.dumps({'time': elapsed, 'rss': rss, 'modules': [
+    name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+# Libraries that should only be loaded when they are first used
+LAZY_MODULES = ['markdown', 'bleach', 'bs4', 'html5lib', 'requests']
+
+
+class SQLCounter(object):
+    """Count the SQL statements issued by all database engines. The count is
+    kept separately for each thread, so that the statements of concurrent
+    operations are not mixed.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def __enter__(self):
+        event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(Engine, 'after_cursor_execute', self.after_execute)
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+    def after_execute(self, *args):
+        self.local.count = self.count + 1
+
+
+class Results(object):
+    """Latencies and query counts for each type of operation, and the
+    latencies from posting a message until it is broadcast.
+    """
+    def __init__(self, counter):
+        self.counter = counter
+        self.operations = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def record(self, name, f, *args, **kwargs):
+        sql_count = self.counter.count
+        start = time.time()
+        rv = f(*args, **kwargs)
+        elapsed = time.time() - start
+        with self.lock:
+            latencies, queries = self.operations.get(name, ([], 0))
+            latencies.append(elapsed)
+            self.operations[name] = (
+                latencies, queries + self.counter.count - sql_count)
+        return rv
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class SimulatedUser(object):
+    def __init__(self, app, results, nickname):
+        self.app = app
+        self.results = results
+        self.nickname = nickname
+        self.client = app.test_client()
+        self.token = None
+        self.socket = None
+        self.last_poll = 0
+
+    def request(self, method, url, data=None, auth=None):
+        headers = {'Content-Type': 'application/json'}
+        if auth is not None:
+            headers['Authorization'] = auth
+        elif self.token is not None:
+            headers['Authorization'] = 'Bearer ' + self.token
+        rv = getattr(self.client, method)(
+            url, headers=headers,
+            data=json.dumps(data) if data is not None else None)
+        db.session.remove()
+        if rv.status_code >= 400:
+            raise RuntimeError('{} {} returned {}'.format(
+                method.upper(), url, rv.status_code))
+        return rv
+
+    def register(self):
+        self.results.record('register', self.request, 'post', '/api/users',
+                            {'nickname': self.nickname,
+                             'password': self.nickname})
+        basic = base64.b64encode((self.nickname + ':' + self.nickname).encode(
+            'utf-8')).decode('utf-8')
+        rv = self.results.record('get_token', self.request, 'post',
+                                 '/api/tokens', auth='Basic ' + basic)
+        self.token = json.loads(rv.get_data(as_text=True))['token']
+        self.socket = socketio.test_client(self.app)
+
+    def heartbeat(self):
+        self.results.record('heartbeat', self.socket.emit, 'ping_user',
+                            self.token)
+        db.session.remove()
+
+    def post_rest(self, source):
+        self.results.record('post_rest', self.request, 'post',
+                            '/api/messages', {'source': source})
+
+    def post_socketio(self, source):
+        self.results.record('post_socketio', self.socket.emit,
+                            'post_message', {'source': source}, self.token)
+        db.session.remove()
+
+    def poll(self):
+        since = self.last_poll
+        self.last_poll = int(time.time())
+        self.results.record('poll_messages', self.request, 'get',
+                            '/api/messages?updated_since=' + str(since))
+        self.results.record('poll_users', self.request, 'get',
+                            '/api/users?updated_since=' + str(since))
+
+    def received(self, source):
+        """Drain the Socket.IO events received by this user, and return True
+        if the given message was among them.
+        """
+        found = False
+        for pkt in self.socket.get_received():
+            if pkt['name'] == 'updated_model' and \
+                    pkt['args'][0]['class'] == 'Message' and \
+                    pkt['args'][0]['model']['source'] == source:
+                found = True
+        return found
+
+    def simulate(self, index, num_messages, poll_every):
+        """Post messages, alternating between REST and Socket.IO, with a
+        heartbeat after each one and a poll every poll_every messages.
+        """
+        with self.app.app_context():
+            for i in range(num_messages):
+                source = 'message {} from {}'.format(i, self.nickname)
+                start = time.time()
+                if (i + index) % 2 == 0:
+                    self.post_rest(source)
+                else:
+                    self.post_socketio(source)
+                # messages posted through Socket.IO are broadcast to all
+                # the users, including the one that posted them, while
+                # those posted through REST are only seen by polling
+                if self.received(source):
+                    self.results.add_latency(time.time() - start)
+                self.heartbeat()
+                if i % poll_every == 0:
+                    self.poll()
+
+    def disconnect(self):
+        self.socket.disconnect()
+
+
+def is_scratch_database(url):
+    """Return True if the database at url can be deleted without asking,
+    which is the case for in-memory SQLite databases and SQLite files whose
+    name starts with "bench".
+    """
+    url = make_url(url)
+    if url.drivername.split('+')[0] != 'sqlite':
+        return False
+    return not url.database or url.database == ':memory:' or \
+        os.path.basename(url.database).startswith('bench')
+
+
+def unsafe_databases(app):
+    """Return the URLs of the databases of the application that are not
+    scratch databases.
+    """
+    urls = [app.config['SQLALCHEMY_DATABASE_URI']] + list(
+        (app.config.get('SQLALCHEMY_BINDS') or {}).values())
+    return [url for url in urls if not is_scratch_database(url)]
+
+
+def run(app, num_users=10, num_messages=10, poll_every=5, force=False):
+    """Run the benchmark, print a report and return the results. Unless
+    force is True, RuntimeError is raised if the application has databases
+    that are not scratch databases.
+    """
+    if not force and unsafe_databases(app):
+        raise RuntimeError('The benchmark would delete all the data in '
+                           '{}'.format(', '.join(unsafe_databases(app))))
+
+    # The Celery tasks run eagerly in this process, using the auxiliary
+    # application instance. Creating it initializes a new Socket.IO server,
+    # so it must be done before the test clients are created.
+    from . import wsgi_aux  # noqa
+
+    with app.app_context(), SQLCounter() as counter:
+        db.drop_all()
+        db.create_all()
+        results = Results(counter)
+
+        users = [SimulatedUser(app, results, 'user' + str(i))
+                 for i in range(num_users)]
+        for user in users:
+            user.register()
+            user.heartbeat()
+
+        errors = []
+
+        def simulate(user, index):
+            try:
+                user.simulate(index, num_messages, poll_every)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=simulate, args=(user, i))
+                   for i, user in enumerate(users)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+        posted = num_users * num_messages
+
+        for user in users:
+            user.disconnect()
+        db.drop_all()
+
+    print('{} users, {} messages in {:.2f} seconds: {:.1f} messages/s'.format(
+        num_users, posted, elapsed, posted / elapsed))
+    print('Socket.IO post to broadcast latency (ms): p50={:.2f} p90={:.2f} '
+          'p99={:.2f} max={:.2f}'.format(
+              *[percentile(results.latencies, p) * 1000
+                for p in [50, 90, 99, 100]]))
+    print('')
+    print('{:<16}{:>8}{:>10}{:>10}{:>10}{:>14}'.format(
+        'operation', 'count', 'p50 ms', 'p99 ms', 'max ms', 'queries/op'))
+    for name, (latencies, queries) in sorted(results.operations.items()):
+        print('{:<16}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>14.1f}'.format(
+            name, len(latencies), percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            percentile(latencies, 100) * 1000,
+            float(queries) / len(latencies)))
+    return results
+
+
+def startup(config_name, num_runs=5):
+    """Measure the startup time and peak memory of web and worker processes
+    and print a report.
+    """
+    env = dict(os.environ, FLACK_CONFIG=config_name)
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print('{:<8}{:>12}{:>12}  {}'.format('process', 'ms', 'max RSS KB',
+                                         'lazy modules loaded'))
+    for kind in ['web', 'worker']:
+        results = []
+        for i in range(num_runs):
+            out = subprocess.check_output(
+                [sys.executable, '-c', STARTUP_SCRIPT, kind] + LAZY_MODULES,
+                env=env, cwd=cwd)
+            results.append(json.loads(out.decode('utf-8').splitlines()[-1]))
+        print('{:<8}{:>12.1f}{:>12}  {}'.format(
+            kind, percentile([r['time'] for r in results], 50) * 1000,
+            int(percentile([r['rss'] for r in results], 50)),
+            ', '.join(results[-1]['modules']) or '-'))
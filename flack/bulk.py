@@ -0,0 +1,210 @@
+"""Bulk export, import and re-rendering of users and messages.
+
+The data is written as newline delimited JSON, with one object per line and
+a "type" key that is "user", "message" or "archived_message", the last one
+for the messages that the retention job moved to the archive. All the users
+are written before the messages, so that the users referenced by a message
+always exist when the file is imported. Both directions work in chunks, so
+memory usage does not depend on the size of the dataset. The same applies to
+re-rendering the HTML of the stored messages.
+"""
+import json
+import multiprocessing
+import os
+
+from . import db, hashing, search
+from .models import User, Message, ArchivedMessage, render_markdown
+
+USER_COLUMNS = ['id', 'created_at', 'updated_at', 'last_seen_at', 'nickname',
+                'password_hash', 'online']
+MESSAGE_COLUMNS = ['id', 'created_at', 'updated_at', 'source', 'html',
+                   'user_id']
+ARCHIVED_MESSAGE_COLUMNS = MESSAGE_COLUMNS + ['archived_at']
+
+
+def export_ndjson(f, chunk_size=1000):
+    """Write all the users, messages and archived messages to the file
+    object f, and return the number of objects written.
+    """
+    count = 0
+    for type_, model, columns in [
+            ('user', User, USER_COLUMNS),
+            ('message', Message, MESSAGE_COLUMNS),
+            ('archived_message', ArchivedMessage, ARCHIVED_MESSAGE_COLUMNS)]:
+        query = db.session.query(
+            *[getattr(model, column) for column in columns]).order_by(
+                model.id).yield_per(chunk_size)
+        for row in query:
+            data = row._asdict()
+            data['type'] = type_
+            f.write(json.dumps(data, sort_keys=True) + '\n')
+            count += 1
+    return count
+
+
+class Renderer(object):
+    """Render markdown sources to HTML with a pool of processes."""
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        if hashing.monkey_patched():
+            # a process pool does not work with a green standard library
+            self.processes = 1
+        self.pool = None
+
+    def render(self, sources):
+        """Return the HTML for the given list of sources."""
+        if self.processes == 1 or len(sources) <= 1:
+            return [render_markdown(source) for source in sources]
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self.pool.map(
+            render_markdown, sources,
+            chunksize=max(1, len(sources) // (self.processes * 4)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class Importer(object):
+    """Insert objects read from an NDJSON file in batches.
+
+    The rows are inserted with Core statements, one executemany per batch,
+    which bypasses the ORM and the set event that renders messages. Messages
+    that come with their HTML are stored as given. Those that do not are
+    rendered by a pool of processes.
+    """
+    def __init__(self, batch_size=1000, processes=None):
+        self.batch_size = batch_size
+        self.renderer = Renderer(processes)
+        self.type = None
+        self.batch = []
+        self.counts = {'user': 0, 'message': 0, 'archived_message': 0}
+
+    def add(self, data):
+        type_ = data.pop('type', None)
+        if type_ not in self.counts:
+            raise ValueError('Invalid object type: {}'.format(type_))
+        if type_ != self.type:
+            self.flush()
+            self.type = type_
+        self.batch.append(data)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.type == 'user':
+            rows = [{column: data.get(column) for column in USER_COLUMNS}
+                    for data in self.batch]
+            db.session.execute(User.__table__.insert(), rows)
+        elif self.type == 'message':
+            rows = [{column: data.get(column) for column in MESSAGE_COLUMNS}
+                    for data in self.batch]
+            self.render([row for row in rows if row['html'] is None])
+            db.session.execute(Message.__table__.insert(), rows)
+            search.get_backend().index(db.session.connection(), [
+                (row['id'], row['source']) for row in rows])
+        elif self.type == 'archived_message':
+            # archived messages are not searchable, so they are not indexed
+            rows = [{column: data.get(column)
+                     for column in ARCHIVED_MESSAGE_COLUMNS}
+                    for data in self.batch]
+            self.render([row for row in rows if row['html'] is None])
+            db.session.execute(ArchivedMessage.__table__.insert(), rows)
+        db.session.commit()
+        self.counts[self.type] += len(self.batch)
+        self.batch = []
+
+    def render(self, rows):
+        """Render the HTML of the given message rows."""
+        htmls = self.renderer.render([row['source'] for row in rows])
+        for row, html in zip(rows, htmls):
+            row['html'] = html
+
+    def close(self):
+        self.flush()
+        self.renderer.close()
+        if db.engine.dialect.name == 'postgresql':
+            # the ids were given explicitly, so the sequences need to be
+            # moved past them
+            for table in ['users', 'messages']:
+                db.session.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "COALESCE(MAX(id), 1)) FROM {0}".format(table))
+            db.session.commit()
+
+
+def import_ndjson(f, batch_size=1000, processes=None):
+    """Import the users, messages and archived messages in the file object
+    f, and return the number of each type imported as a dictionary.
+    """
+    importer = Importer(batch_size=batch_size, processes=processes)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                importer.add(json.loads(line))
+    finally:
+        importer.close()
+    return importer.counts
+
+
+def rerender_messages(chunk_size=1000, processes=None, checkpoint=None):
+    """Render the HTML of all the stored messages again, for example after
+    the allowed tags or the markdown options change, and return the number
+    of messages that changed.
+
+    The messages are read in chunks of consecutive ids and rendered by a pool
+    of processes. The HTML that changed is written back with one executemany
+    UPDATE per chunk, which also sets the updated_at timestamp of those
+    messages, so that clients that poll for changes get the new HTML. If a
+    checkpoint file is given, the last id processed is written to it after
+    each chunk is committed, and a new run resumes after that id. The file is
+    deleted when the run completes, so that the next run starts over.
+    """
+    last_id = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            last_id = int(f.read().strip() or 0)
+    # updated_at is set by its onupdate default
+    update = Message.__table__.update().where(
+        Message.id == db.bindparam('message_id')).values(
+            html=db.bindparam('new_html'))
+    renderer = Renderer(processes)
+    changed = 0
+    try:
+        while True:
+            rows = db.session.execute(
+                db.select([Message.id, Message.source, Message.html]).where(
+                    Message.id > last_id).order_by(Message.id).limit(
+                        chunk_size)).fetchall()
+            if not rows:
+                break
+            htmls = renderer.render([row.source for row in rows])
+            updates = []
+            for row, html in zip(rows, htmls):
+                # links expanded by Message.expand_links() are appended to the
+                # rendered HTML in a blockquote, a tag that rendering strips,
+                # so they are carried over to the new HTML
+                expanded = row.html.find('<blockquote>')
+                if expanded != -1:
+                    html += row.html[expanded:]
+                if html != row.html:
+                    updates.append({'message_id': row.id, 'new_html': html})
+            if updates:
+                db.session.execute(update, updates)
+            db.session.commit()
+            changed += len(updates)
+            last_id = rows[-1].id
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(last_id))
+    finally:
+        renderer.close()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return changed
@@ -0,0 +1,151 @@
+"""Cache of the serialized representations of users and messages.
+
+The same version of an object is exported many times: by the REST endpoints
+that return it, by the clients that poll the message list, and by
+push_model() when it is broadcast to the Socket.IO clients. With this cache
+the dictionary and the JSON text of each version are built once, by the
+first reader, and reused by all the others.
+
+Entries are keyed by class and id, and they record the column values they
+were built from, including updated_at. An entry is only used for an object
+or row with the same values, so changes made by other processes, or by Core
+statements that bypass the session, are never hidden by the cache. Entries
+for objects that are updated or deleted through the session are also
+dropped when the session is flushed, so that they do not wait in the cache
+until they are evicted.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+
+from flask import current_app, has_app_context, json
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .models import User, Message
+
+# names of the columns that make up the version of each class, which are
+# those returned by its select() query
+_columns = {}
+
+
+def version(cls, row):
+    """Return the column values of an object or row of the given class."""
+    names = _columns.get(cls)
+    if names is None:
+        names = _columns[cls] = [c.name for c in cls.select().columns]
+    return tuple(getattr(row, name) for name in names)
+
+
+class Entry(object):
+    """The serialized representations of a version of an object."""
+    def __init__(self, values):
+        self.values = values
+        self.lock = threading.Lock()
+        self.data = None
+        self._json = None
+
+    def build(self, cls, row):
+        # concurrent readers of a new version wait for the first one to
+        # build it, instead of building it again
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    self.data = cls.row_to_dict(row)
+        return self
+
+    @property
+    def json(self):
+        if self._json is None:
+            with self.lock:
+                if self._json is None:
+                    self._json = json.dumps(self.data)
+        return self._json
+
+
+class ObjectCache(object):
+    """Thread-safe LRU cache of the serialized representations of objects,
+    with room for max_size of them.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cls, row):
+        """Return the entry for an object or row of the given class, which
+        is built if the cache does not have this version of it.
+        """
+        key = (cls.__name__, row.id)
+        values = version(cls, row)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry.values != values:
+                entry = Entry(values)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry.build(cls, row)
+
+    def discard(self, cls, id):
+        """Drop the entry for an object, if there is one."""
+        with self.lock:
+            self.entries.pop((cls.__name__, id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_cache():
+    """Return the object cache of the current application, creating it if
+    necessary. None is returned if OBJECT_CACHE_SIZE is 0.
+    """
+    cache = current_app.extensions.get('object_cache')
+    if cache is None:
+        size = current_app.config['OBJECT_CACHE_SIZE']
+        if not size:
+            return None
+        cache = ObjectCache(size)
+        current_app.extensions['object_cache'] = cache
+    return cache
+
+
+def to_dict(cls, row):
+    """Export an object or row of the given class to a dictionary, which
+    must not be modified, since it is shared with other readers.
+    """
+    cache = get_cache()
+    if cache is None:
+        return cls.row_to_dict(row)
+    return cache.get(cls, row).data
+
+
+def to_json(cls, row):
+    """Export an object or row of the given class as JSON text."""
+    cache = get_cache()
+    if cache is None:
+        return json.dumps(cls.row_to_dict(row))
+    return cache.get(cls, row).json
+
+
+def jsonify_model(cls, row):
+    """jsonify replacement for a single object or row of the given class."""
+    return current_app.response_class(
+        to_json(cls, row) + '\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+@event.listens_for(Session, 'after_flush')
+def on_flush(session, flush_context):
+    """Drop the entries of the objects that were updated or deleted."""
+    if not has_app_context() or \
+            'object_cache' not in current_app.extensions:
+        return
+    cache = current_app.extensions['object_cache']
+    # the session still has the lists of objects from before the flush
+    for obj in itertools.chain(session.dirty, session.deleted):
+        if isinstance(obj, (User, Message)):
+            identity = inspect(obj).identity
+            if identity is not None:
+                cache.discard(obj.__class__, identity[0])
@@ -0,0 +1,99 @@
+import zlib
+
+from flask import current_app, request
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+compressible_mimetypes = ['application/json', 'application/javascript',
+                          'text/html', 'text/css', 'text/plain']
+
+
+def compress_response(response):
+    """after_request handler that compresses responses with gzip or brotli,
+    according to what the client accepts.
+    """
+    config = current_app.config
+    if not config['COMPRESS_RESPONSES'] or \
+            response.mimetype not in compressible_mimetypes:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # the length of a streamed response is not known in advance, so it is
+        # always compressed, chunk by chunk as it is generated
+        response.response = compress_stream(response.response,
+                                            response.charset,
+                                            get_compressor(encoding))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        compressor = get_compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def choose_encoding():
+    """Return the best encoding supported by the client, or None."""
+    accepted = request.accept_encodings
+    candidates = ['gzip']
+    if brotli is not None and current_app.config['COMPRESS_BROTLI']:
+        candidates.insert(0, 'br')
+    encoding = accepted.best_match(candidates)
+    if encoding is None or accepted[encoding] == 0:
+        return None
+    return encoding
+
+
+def get_compressor(encoding):
+    """Return a compressor object for the given encoding. The compression
+    level from the configuration is clamped to the range supported by the
+    algorithm, so that a misconfiguration cannot make compression eat all
+    the CPU.
+    """
+    level = current_app.config['COMPRESS_LEVEL']
+    if encoding == 'br':
+        return _BrotliCompressor(min(max(level, 0), 11))
+    return zlib.compressobj(min(max(level, 1), 9), zlib.DEFLATED,
+                            16 + zlib.MAX_WBITS)
+
+
+def compress_stream(chunks, charset, compressor):
+    """Compress an iterable of response chunks. The compressor is created by
+    the caller, because the generator runs after the application context is
+    gone.
+    """
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class _BrotliCompressor(object):
+    """Wrapper that gives brotli's compressor the zlib interface."""
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
@@ -1,70 +1,237 @@
-from flask import g, session
+import time
 
-from . import db, socketio, celery
+from flask import current_app, g, request, session
+from flask_socketio import join_room
+from sqlalchemy import inspect
+
+from . import db, socketio, celery, stats, tracing, replica, ratelimit, \
+    packing, cache, presence
 from .models import User, Message
 from .auth import verify_token
+from .batch import Batcher
+from .tasks import get_executor
 
 
 def push_model(model):
     """Push the model to all connected Socket.IO clients."""
-    socketio.emit('updated_model', {'class': model.__class__.__name__,
-                                    'model': model.to_dict()})
+    with tracing.span('push_model'):
+        # the dictionary is shared with the REST endpoints that return the
+        # same version of the model
+        data = {'class': model.__class__.__name__,
+                'model': cache.to_dict(model.__class__, model)}
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            data['meta'] = {'trace_id': trace_id}
+        if packing.enabled():
+            # each encoding is sent to its own room of clients
+            socketio.emit('updated_model', data, room=packing.JSON_ROOM)
+            socketio.emit('updated_model',
+                          packing.pack_model(model, trace_id),
+                          room=packing.MSGPACK_ROOM)
+        else:
+            socketio.emit('updated_model', data)
+    stats.add_emit()
+
+
+@socketio.on('connect')
+def on_connect():
+    """A Socket.IO client has connected. Add it to the room of the encoding
+    it wants for its updated_model events.
+    """
+    if packing.enabled():
+        join_room(packing.client_room())
 
 
 @socketio.on('ping_user')
+@stats.track_event('ping_user')
+@tracing.trace_event('ping_user')
 def on_ping_user(token):
     """Clients must send this event periodically to keep the user online."""
-    verify_token(token, add_to_session=True)
+    verify_token(token)
     if g.current_user:
         # Mark the user as still online
         g.current_user.ping()
+        track_connection()
 
 
-@celery.task
-def post_message(user_id, data):
-    """Celery task that posts a message."""
-    from .wsgi_aux import app
-    with app.app_context():
-        user = User.query.get(user_id)
-        if user is None:
-            return
-
-        # Write the message to the database
-        msg = Message.create(data, user=user, expand_links=False)
-        db.session.add(msg)
-        db.session.commit()
-
-        # broadcast the message to all clients
+def track_connection():
+    """Count the Socket.IO connection of the current event as a connection
+    of the authenticated user.
+    """
+    # the user instance was expired by the commit in verify_token
+    user_id = inspect(g.current_user).identity[0]
+    previous_id = session.get('user_id')
+    if previous_id is not None and previous_id != user_id:
+        # the connection is now used by a different user
+        presence.disconnect(previous_id, request.sid)
+    session['user_id'] = user_id
+    presence.connect(user_id, request.sid)
+
+
+def create_messages(batch):
+    """Write a batch of messages to the database with a single commit and
+    broadcast them to all clients. Each item in the batch is a
+    (user_id, data, trace_id) tuple.
+    """
+    # users that are already in the session, such as the one authenticated
+    # by the Socket.IO handler when the task runs eagerly, are not loaded
+    # again, and all the others are loaded with a single query
+    user_ids = set(item[0] for item in batch)
+    users = {}
+    for user_id in user_ids:
+        user = db.session.identity_map.get(
+            db.session.identity_key(User, user_id))
+        if user is not None:
+            users[user_id] = user
+    missing = user_ids - set(users)
+    if missing:
+        users.update((user.id, user) for user in
+                     User.query.filter(User.id.in_(missing)))
+    msgs = []
+    trace_ids = []
+    for user_id, data, trace_id in batch:
+        if user_id not in users or not isinstance(data, dict) or \
+                'source' not in data:
+            continue
+        msgs.append(Message.create(data, user=users[user_id],
+                                   expand_links=False))
+        trace_ids.append(trace_id)
+    if not msgs:
+        return
+
+    # Write the messages to the database
+    db.session.add_all(msgs)
+    db.session.flush()
+    ids = [msg.id for msg in msgs]
+    db.session.commit()
+
+    # broadcast the messages to all clients, after reloading them all with a
+    # single query, since the commit expired them
+    Message.query.filter(Message.id.in_(ids)).all()
+    for msg, trace_id in zip(msgs, trace_ids):
+        tracing.start_trace(trace_id)
         push_model(msg)
 
-        if msg.expand_links():
-            db.session.commit()
+    expanded = [(msg, trace_id) for msg, trace_id in zip(msgs, trace_ids)
+                if msg.expand_links()]
+    if expanded:
+        ids = [msg.id for msg, trace_id in expanded]
+        db.session.commit()
 
-            # broadcast the message again, now with links expanded
+        # broadcast the messages again, now with links expanded
+        Message.query.filter(Message.id.in_(ids)).all()
+        for msg, trace_id in expanded:
+            tracing.start_trace(trace_id)
             push_model(msg)
 
+
+@celery.task(bind=True)
+def post_messages(self, batch):
+    """Celery task that posts a batch of messages."""
+    from .wsgi_aux import app
+    with app.app_context(), tracing.span('task post_messages'):
+        tracing.start_trace(tracing.task_trace_id(self.request))
+        create_messages(batch)
+
         # clean up the database session
         db.session.remove()
 
 
+@celery.task(bind=True)
+def post_message(self, user_id, data):
+    """Celery task that posts a message. This task is not used anymore, but
+    it is kept so that tasks queued by older versions can still run.
+    """
+    from .wsgi_aux import app
+    with app.app_context(), tracing.span('task post_message'):
+        trace_id = tracing.task_trace_id(self.request)
+        create_messages([(user_id, data, trace_id)])
+
+        # clean up the database session
+        db.session.remove()
+
+
+def run_create_messages(app, batch):
+    """Write a batch of messages from the in-process executor."""
+    with app.app_context(), tracing.span('task create_messages'):
+        create_messages(batch)
+
+        # clean up the database session
+        db.session.remove()
+
+
+def send_messages(batch):
+    """Send a batch of messages to a Celery worker, or to the in-process
+    executor.
+    """
+    start = time.time()
+    executor = get_executor()
+    if executor is not None:
+        # when the queue is full this waits for room, which slows down the
+        # clients that are posting instead of dropping their messages
+        executor.submit(run_create_messages,
+                        args=(current_app._get_current_object(), batch),
+                        block=True)
+        stats.add_enqueue(start)
+        tracing.record_span('enqueue create_messages', start)
+        return
+    post_messages.apply_async(args=(batch,), headers=tracing.task_headers())
+    stats.add_enqueue(start)
+    tracing.record_span('enqueue post_messages', start)
+
+
+def get_message_batcher():
+    """Return the batcher that collects the messages posted through
+    Socket.IO, creating it if necessary.
+    """
+    batcher = current_app.extensions.get('message_batcher')
+    if batcher is None:
+        app = current_app._get_current_object()
+
+        def flush(batch):
+            with app.app_context():
+                send_messages(batch)
+
+        batcher = current_app.extensions.setdefault(
+            'message_batcher', Batcher(
+                flush, max_size=app.config['MESSAGE_BATCH_SIZE'],
+                max_delay=app.config['MESSAGE_BATCH_MAX_DELAY']))
+    return batcher
+
+
 @socketio.on('post_message')
+@stats.track_event('post_message')
+@tracing.trace_event('post_message')
+@ratelimit.limit_event('post_message')
 def on_post_message(data, token):
     """Clients send this event to when the user posts a message."""
-    verify_token(token, add_to_session=True)
+    verify_token(token)
     if g.current_user:
-        post_message.apply_async(args=(g.current_user.id, data))
+        rv = ratelimit.check_token('post_message', token)
+        if rv is not None:
+            return ratelimit.error_ack(rv)
+        # the id is taken from the identity key, as the user instance was
+        # expired by the commit in verify_token
+        user_id = inspect(g.current_user).identity[0]
+        track_connection()
+        item = (user_id, data, tracing.current_trace_id())
+        if current_app.config['MESSAGE_BATCH_MAX_DELAY'] > 0:
+            # messages are sent to Celery in batches, so that they can be
+            # written to the database with a single commit
+            get_message_batcher().add(item)
+        else:
+            send_messages([item])
+        replica.mark_write(g.current_user)
 
 
 @socketio.on('disconnect')
+@stats.track_event('disconnect')
+@tracing.trace_event('disconnect')
 def on_disconnect():
     """A Socket.IO client has disconnected. If we know who the user is, then
     update our state accordingly.
     """
-    nickname = session.get('nickname')
-    if nickname:
-        # we have the nickname in the session, we can mark the user as offline
-        user = User.query.filter_by(nickname=nickname).first()
-        if user:
-            user.online = False
-            db.session.commit()
-            push_model(user)
+    user_id = session.get('user_id')
+    if user_id is not None:
+        # the user is marked offline once their last connection is gone
+        presence.disconnect(user_id, request.sid)
@@ -0,0 +1,136 @@
+"""In-process task executor, which runs background tasks in the server
+process when TASK_BACKEND is "local", so that no broker, result backend or
+Celery workers are needed.
+
+When eventlet or gevent have monkey patched the standard library, the
+threads of the executor are greenlets.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from celery import states
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The executor has too many tasks waiting to run."""
+    pass
+
+
+class Executor(object):
+    """Pool of threads that run tasks from a bounded queue. The results of
+    the tasks are kept in memory for result_ttl seconds after they finish,
+    with the same states as Celery tasks.
+    """
+    def __init__(self, threads=4, max_queue=100, result_ttl=300,
+                 drain_timeout=30):
+        self.num_threads = threads
+        self.queue = queue.Queue(max_queue)
+        self.result_ttl = result_ttl
+        self.results = {}
+        self.last_prune = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.closed = False
+        atexit.register(self.shutdown, drain_timeout)
+
+    def submit(self, f, args=(), block=False, timeout=None):
+        """Queue a task and return its id. If the queue is full, QueueFull
+        is raised, after waiting for up to timeout seconds if block is
+        True.
+        """
+        if self.closed:
+            raise RuntimeError('The executor has been shut down')
+        self.start()
+        id = uuid.uuid4().hex
+        with self.lock:
+            self.results[id] = (states.RECEIVED, None, None)
+        try:
+            self.queue.put((id, f, args), block, timeout)
+        except queue.Full:
+            with self.lock:
+                del self.results[id]
+            raise QueueFull()
+        return id
+
+    def status(self, id):
+        """Return the state and the result of a task. Tasks that are unknown,
+        or whose result expired, are in the PENDING state.
+        """
+        with self.lock:
+            self.prune()
+            state, info, expires_at = self.results.get(
+                id, (states.PENDING, None, None))
+        return state, info
+
+    def start(self):
+        if len(self.threads) < self.num_threads:
+            with self.lock:
+                while len(self.threads) < self.num_threads:
+                    thread = threading.Thread(target=self.worker)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                id, f, args = item
+                with self.lock:
+                    self.results[id] = (states.STARTED, None, None)
+                try:
+                    state, info = states.SUCCESS, f(*args)
+                except Exception as exc:
+                    logger.exception('Task %s failed', id)
+                    state, info = states.FAILURE, exc
+                with self.lock:
+                    self.results[id] = (state, info,
+                                        time.time() + self.result_ttl)
+            finally:
+                self.queue.task_done()
+
+    def prune(self):
+        # the expired results are removed at most once per second
+        now = time.time()
+        if now - self.last_prune < 1:
+            return
+        self.last_prune = now
+        for id, (state, info, expires_at) in list(self.results.items()):
+            if expires_at is not None and expires_at < now:
+                del self.results[id]
+
+    def shutdown(self, timeout=None):
+        """Stop accepting tasks, and wait for up to timeout seconds for the
+        tasks in the queue to finish.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.time(), 0)
+
+        try:
+            # the threads exit when they get to these markers, which are
+            # queued behind the pending tasks, so they also have to wait for
+            # room in the queue
+            for thread in self.threads:
+                self.queue.put(None, timeout=remaining())
+            for thread in self.threads:
+                thread.join(remaining())
+                if thread.is_alive():
+                    raise queue.Full()
+        except queue.Full:
+            logger.warning('Shut down with tasks still running')
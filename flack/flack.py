@@ -1,11 +1,12 @@
 import threading
 import time
 
-from flask import Blueprint, render_template, jsonify, current_app
+from flask import Blueprint, render_template, jsonify, current_app, \
+    request, g
 
 from .models import User
 from .events import push_model
-from . import db, stats
+from . import db, stats, tracing, replica
 
 main = Blueprint('main', __name__)
 
@@ -30,8 +31,40 @@ def before_first_request():
 
 @main.before_app_request
 def before_request():
-    """Update requests per second stats."""
+    """Update requests per second stats and start recording metrics. A trace
+    is also started, unless the request already carries one.
+    """
     stats.add_request()
+    stats.start_operation('http', str(request.endpoint))
+    # requests that run in Celery carry the trace id of the original request
+    trace_id = request.environ.get('flack.trace_id')
+    if trace_id is None:
+        trace_id = tracing.client_trace_id(request.headers.get('X-Trace-Id'))
+    tracing.start_trace(trace_id)
+    g.request_start = time.time()
+
+
+@main.after_app_request
+def after_request(response):
+    """Record writes for read replica routing and return the trace id to the
+    client.
+    """
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and \
+            g.get('current_user') is not None:
+        replica.mark_write(g.current_user)
+    trace_id = tracing.current_trace_id()
+    if trace_id:
+        response.headers['X-Trace-Id'] = trace_id
+    return response
+
+
+@main.teardown_app_request
+def teardown_request(exc):
+    """Record the metrics and the trace span for the request."""
+    stats.end_operation()
+    if 'request_start' in g:
+        tracing.record_span('http ' + str(request.endpoint),
+                            g.pop('request_start'))
 
 
 @main.route('/')
@@ -42,4 +75,16 @@ def index():
 
 @main.route('/stats', methods=['GET'])
 def get_stats():
-    return jsonify({'requests_per_second': stats.requests_per_second()})
+    metrics = {'http': {}, 'event': {}}
+    for (kind, name), metric in stats.get_metrics().items():
+        metrics[kind][name] = metric
+    return jsonify({'requests_per_second': stats.requests_per_second(),
+                    'endpoints': metrics['http'],
+                    'events': metrics['event']})
+
+
+@main.route('/stats/metrics', methods=['GET'])
+def get_metrics():
+    """Return metrics in the Prometheus text format."""
+    return stats.prometheus_metrics(), 200, \
+        {'Content-Type': 'text/plain; version=0.0.4'}
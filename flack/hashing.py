@@ -0,0 +1,78 @@
+import sys
+import threading
+
+from flask import current_app, has_app_context
+from werkzeug import security
+
+# Default number of hashes that can run at the same time, used when there is
+# no application context
+DEFAULT_CONCURRENCY = 4
+
+# Semaphores that limit concurrent hashing, indexed by their size
+semaphores = {}
+semaphores_lock = threading.Lock()
+
+
+def get_semaphore():
+    if has_app_context():
+        size = current_app.config['PASSWORD_HASH_CONCURRENCY']
+    else:
+        size = DEFAULT_CONCURRENCY
+    semaphore = semaphores.get(size)
+    if semaphore is None:
+        with semaphores_lock:
+            semaphore = semaphores.get(size)
+            if semaphore is None:
+                # when the threading module is monkey patched this is a green
+                # semaphore, so waiting for it does not block the hub
+                semaphore = semaphores[size] = threading.Semaphore(size)
+    return semaphore
+
+
+def monkey_patched():
+    """Return "eventlet" or "gevent" if the standard library was monkey
+    patched by one of these libraries, or else None.
+    """
+    eventlet_patcher = sys.modules.get('eventlet.patcher')
+    if eventlet_patcher is not None and \
+            eventlet_patcher.is_monkey_patched('thread'):
+        return 'eventlet'
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey is not None and \
+            gevent_monkey.is_module_patched('threading'):
+        return 'gevent'
+    return None
+
+
+def offload(f, *args, **kwargs):
+    """Run a CPU bound function in a real OS thread and wait for it.
+
+    When eventlet or gevent have monkey patched the standard library, all the
+    greenlets of the process run in a single OS thread, so a function that
+    computes for a long time stops all the other requests and WebSocket
+    connections. Here the function is sent to the thread pool of the green
+    library, and only the calling greenlet waits for the result. Without
+    monkey patching the function is called directly, as it is already
+    running in its own thread.
+    """
+    with get_semaphore():
+        patched = monkey_patched()
+        if patched == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(f, *args, **kwargs)
+        elif patched == 'gevent':
+            import gevent
+            return gevent.get_hub().threadpool.apply(f, args, kwargs)
+        return f(*args, **kwargs)
+
+
+def generate_password_hash(password):
+    """Hash a password without blocking other greenlets."""
+    return offload(security.generate_password_hash, password)
+
+
+def check_password_hash(password_hash, password):
+    """Check a password against its hash without blocking other
+    greenlets.
+    """
+    return offload(security.check_password_hash, password_hash, password)
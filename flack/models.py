@@ -2,16 +2,22 @@ import binascii
 import os
 
 from flask import abort, g
-from werkzeug.security import generate_password_hash, check_password_hash
-from markdown import markdown
-import bleach
-from bs4 import BeautifulSoup
-import requests
-
-from . import db
+from . import db, hashing, sqlite
 from .utils import timestamp, url_for
 
 
+def render_markdown(source):
+    """Render markdown source to HTML with a tag whitelist."""
+    # the rendering libraries are imported when first needed, so that
+    # processes that never render a message do not load them
+    from markdown import markdown
+    import bleach
+    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
+    return bleach.linkify(bleach.clean(
+        markdown(source, output_format='html'),
+        tags=allowed_tags, strip=True))
+
+
 class User(db.Model):
     """The User model."""
     __tablename__ = 'users'
@@ -31,11 +37,11 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.generate_password_hash(password)
         self.token = None  # if user is changing passwords, also revoke token
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hashing.check_password_hash(self.password_hash, password)
 
     def generate_token(self):
         """Creates a 64 character long randomly generated token."""
@@ -67,16 +73,32 @@ class User(db.Model):
 
     def to_dict(self):
         """Export user to a dictionary."""
+        return User.row_to_dict(self)
+
+    @staticmethod
+    def select():
+        """Return a Core select for the public columns of the users table.
+        This is used by read-only endpoints, which do not need the overhead
+        of loading full model instances.
+        """
+        return db.select([User.id, User.created_at, User.updated_at,
+                          User.nickname, User.last_seen_at, User.online])
+
+    @staticmethod
+    def row_to_dict(row):
+        """Export a user given as a model or as a row returned by the query
+        in select() to a dictionary.
+        """
         return {
-            'id': self.id,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at,
-            'nickname': self.nickname,
-            'last_seen_at': self.last_seen_at,
-            'online': self.online,
+            'id': row.id,
+            'created_at': row.created_at,
+            'updated_at': row.updated_at,
+            'nickname': row.nickname,
+            'last_seen_at': row.last_seen_at,
+            'online': row.online,
             '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'messages': url_for('api.get_messages', user_id=self.id),
+                'self': url_for('api.get_user', id=row.id),
+                'messages': url_for('api.get_messages', user_id=row.id),
                 'tokens': url_for('api.new_token')
             }
         }
@@ -88,8 +110,7 @@ class User(db.Model):
                                   User.online == True).all()  # noqa
         for user in users:
             user.online = False
-            db.session.add(user)
-        db.session.commit()
+        sqlite.save(users, 'online')
         return users
 
 
@@ -125,32 +146,46 @@ class Message(db.Model):
 
     def to_dict(self):
         """Export message to a dictionary."""
+        return Message.row_to_dict(self)
+
+    @staticmethod
+    def select():
+        """Return a Core select for the columns of the messages table.
+        This is used by read-only endpoints, which do not need the overhead
+        of loading full model instances.
+        """
+        return db.select([Message.id, Message.created_at, Message.updated_at,
+                          Message.source, Message.html, Message.user_id])
+
+    @staticmethod
+    def row_to_dict(row):
+        """Export a message given as a model or as a row returned by the
+        query in select() to a dictionary.
+        """
         return {
-            'id': self.id,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at,
-            'source': self.source,
-            'html': self.html,
-            'user_id': self.user.id,
+            'id': row.id,
+            'created_at': row.created_at,
+            'updated_at': row.updated_at,
+            'source': row.source,
+            'html': row.html,
+            'user_id': row.user_id,
             '_links': {
-                'self': url_for('api.get_message', id=self.id),
-                'user': url_for('api.get_user', id=self.user.id)
+                'self': url_for('api.get_message', id=row.id),
+                'user': url_for('api.get_user', id=row.user_id)
             }
         }
 
     def render_markdown(self, source):
         """Render markdown source to HTML with a tag whitelist."""
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        self.html = bleach.linkify(bleach.clean(
-            markdown(source, output_format='html'),
-            tags=allowed_tags, strip=True))
+        self.html = render_markdown(source)
 
     def expand_links(self):
         """Expand any links referenced in the message."""
         if '<blockquote>' in self.html:
             # links have been already expanded
             return False
+        from bs4 import BeautifulSoup
+        import requests
         changed = False
         for link in BeautifulSoup(self.html, 'html5lib').select('a'):
             url = link.get('href', '')
@@ -183,3 +218,25 @@ class Message(db.Model):
         target.render_markdown(value)
 
 db.event.listen(Message.source, 'set', Message.on_changed_source)
+
+
+class ArchivedMessage(db.Model):
+    """A message that was moved out of the messages table by the retention
+    job. The columns are the same as in Message, so the rows can be
+    exported with Message.row_to_dict().
+    """
+    __tablename__ = 'messages_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.Integer)
+    updated_at = db.Column(db.Integer)
+    source = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    archived_at = db.Column(db.Integer, default=timestamp)
+
+    @staticmethod
+    def select():
+        """Return a Core select for the message columns of the archive."""
+        return db.select([ArchivedMessage.id, ArchivedMessage.created_at,
+                          ArchivedMessage.updated_at, ArchivedMessage.source,
+                          ArchivedMessage.html, ArchivedMessage.user_id])
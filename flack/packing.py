@@ -0,0 +1,66 @@
+"""Compact binary encoding of the updated_model Socket.IO events.
+
+Clients that connect with "encoding=msgpack" in the query string receive
+updated_model events as a msgpack encoded array instead of a JSON object:
+
+    [class index, [field values], trace id or nil]
+
+The field names are not sent, as they are given by the position of each value
+in the schema of its class. The _links of the model are also omitted, since
+the client builds resource URLs on its own. The decoder in static/app.js has
+a copy of the schemas below, and the two must be kept in sync.
+"""
+from flask import current_app, request
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+SCHEMAS = [
+    ('User', ['id', 'created_at', 'updated_at', 'nickname', 'last_seen_at',
+              'online']),
+    ('Message', ['id', 'created_at', 'updated_at', 'source', 'html',
+                 'user_id']),
+]
+CLASS_INDEXES = {name: index for index, (name, fields) in enumerate(SCHEMAS)}
+
+# Socket.IO rooms for the clients of each encoding
+JSON_ROOM = 'encoding:json'
+MSGPACK_ROOM = 'encoding:msgpack'
+
+
+def enabled():
+    """Return True if binary payloads can be sent to the clients that ask
+    for them.
+    """
+    return msgpack is not None and current_app.config['SOCKETIO_MSGPACK']
+
+
+def client_room():
+    """Return the room for the client that is connecting, according to the
+    encoding it requested.
+    """
+    if request.args.get('encoding') == 'msgpack':
+        return MSGPACK_ROOM
+    return JSON_ROOM
+
+
+def pack_model(model, trace_id=None):
+    """Encode a model as a msgpack payload."""
+    name = model.__class__.__name__
+    fields = SCHEMAS[CLASS_INDEXES[name]][1]
+    return msgpack.packb([CLASS_INDEXES[name],
+                          [getattr(model, field) for field in fields],
+                          trace_id], use_bin_type=True)
+
+
+def unpack_model(payload):
+    """Decode a payload into the dictionary that would have been sent as
+    JSON, without the _links.
+    """
+    index, values, trace_id = msgpack.unpackb(payload, raw=False)
+    name, fields = SCHEMAS[index]
+    data = {'class': name, 'model': dict(zip(fields, values))}
+    if trace_id:
+        data['meta'] = {'trace_id': trace_id}
+    return data
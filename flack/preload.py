@@ -0,0 +1,86 @@
+"""Support for web servers and Celery workers that load the application in a
+master process and then fork the worker processes.
+
+warm_up() builds everything that the workers can share in the master, so
+that it is inherited copy-on-write instead of being built again by each
+worker on its first request. post_fork() runs in each worker, and replaces
+the resources that cannot be shared between processes.
+"""
+import gc
+import logging
+
+from flask import render_template
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(app):
+    """Build the shareable state of the application. This must not connect
+    to the database, the message queue or Celery, and must not start any
+    threads, since none of these survive a fork.
+    """
+    with app.test_request_context():
+        # compile the templates, including the base templates they extend
+        render_template('index.html')
+
+        # load the rendering and scraping libraries, which are otherwise
+        # imported on first use, and initialize their internal state
+        from .models import Message
+        Message().render_markdown('*warm up*')
+        from bs4 import BeautifulSoup
+        BeautifulSoup('<a href="#">warm up</a>', 'html5lib').select('a')
+        import requests  # noqa
+
+    # move all the objects created so far out of the reach of the garbage
+    # collector, so that collections in the workers do not write to (and
+    # copy) the memory pages shared with the master
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+def check_workers(app, workers):
+    """Refuse to run with a configuration that only works in a single
+    process when the server has more than one worker process, and warn about
+    those that work with reduced accuracy.
+    """
+    if workers is None or workers <= 1:
+        return
+    if app.config['TASK_BACKEND'] == 'local':
+        # the results of the tasks are only known to the process that ran
+        # them, so a client polling for them could reach another worker
+        raise RuntimeError('TASK_BACKEND "local" cannot be used with {} '
+                           'worker processes'.format(workers))
+    if app.config['PRESENCE_BACKEND'] == 'memory':
+        # each worker only sees the connections of its own clients, so a
+        # user with connections to several workers is marked offline when
+        # the last connection to any one of them closes
+        logger.warning('PRESENCE_BACKEND "memory" with %d worker processes '
+                       'can mark connected users offline, use a Redis URL '
+                       'instead', workers)
+
+
+def post_fork(app, workers=None):
+    """Replace the per-process resources of the application in a newly
+    forked worker process. The number of worker processes of the server is
+    given in workers, if known.
+    """
+    check_workers(app, workers)
+    # database connections cannot be shared with the parent process
+    with app.app_context():
+        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+        for bind in binds:
+            db.get_engine(app, bind).dispose()
+
+    # the rate limiter, the store of recent writes, the presence backend,
+    # the message batcher and the task executor are created again on first
+    # use, with their own Redis connections and background threads, and
+    # each worker fills its own object cache
+    app.extensions.pop('ratelimit', None)
+    app.extensions.pop('replica_writes', None)
+    app.extensions.pop('presence', None)
+    app.extensions.pop('message_batcher', None)
+    app.extensions.pop('executor', None)
+    app.extensions.pop('object_cache', None)
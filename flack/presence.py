@@ -0,0 +1,187 @@
+"""Tracking of the Socket.IO connections of each user, so that a user is
+marked offline when their last connection closes, and not every time one of
+their browser tabs goes away.
+
+A user is marked offline after a grace period, given by the
+PRESENCE_GRACE_PERIOD configuration variable, during which a new connection
+of the user cancels the change. This covers page reloads, and servers that
+restart and have their clients reconnect to another server. Connections are
+only counted for PRESENCE_TTL seconds after they were last seen, so those
+left behind by a server that crashed do not keep their users online.
+"""
+import logging
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from . import db, sqlite
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend(object):
+    """Connection counts stored in the memory of the process. This only
+    works when all the Socket.IO clients are connected to a single process.
+    """
+    def __init__(self):
+        self.connections = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def connect(self, user_id, sid, ttl):
+        """Record that a connection of the user was seen, which also cancels
+        a pending change to offline.
+        """
+        with self.lock:
+            self.connections.setdefault(user_id, {})[sid] = time.time()
+            self.pending.pop(user_id, None)
+
+    def disconnect(self, user_id, sid, ttl):
+        """Remove a connection of the user. If it was the last one, a token
+        for the change to offline is returned.
+        """
+        now = time.time()
+        with self.lock:
+            connections = self.connections.get(user_id, {})
+            connections.pop(sid, None)
+            for other_sid, seen_at in list(connections.items()):
+                if seen_at < now - ttl:
+                    del connections[other_sid]
+            if connections:
+                return None
+            self.connections.pop(user_id, None)
+            token = self.pending[user_id] = uuid.uuid4().hex
+            return token
+
+    def expire(self, user_id, token):
+        """Return True if the user has to be marked offline, which is the
+        case if the change was not cancelled, or replaced by a later one.
+        Only one caller gets True for each change.
+        """
+        with self.lock:
+            if self.pending.get(user_id) != token:
+                return False
+            del self.pending[user_id]
+            return True
+
+
+class RedisBackend(object):
+    """Connection counts stored in Redis, shared by all the processes that
+    use the same Redis server.
+    """
+    disconnect_script = '''
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+if redis.call('ZCARD', KEYS[1]) > 0 then
+    return nil
+end
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ttl)
+return ARGV[4]
+'''
+    expire_script = '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+return 1
+'''
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.disconnect_script = self.redis.register_script(
+            self.disconnect_script)
+        self.expire_script = self.redis.register_script(self.expire_script)
+
+    @staticmethod
+    def keys(user_id):
+        return ('flack:presence:{}'.format(user_id),
+                'flack:presence:{}:pending'.format(user_id))
+
+    def connect(self, user_id, sid, ttl):
+        connections, pending = self.keys(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zadd(connections, {sid: time.time()})
+        pipe.expire(connections, ttl)
+        pipe.delete(pending)
+        pipe.execute()
+
+    def disconnect(self, user_id, sid, ttl):
+        token = self.disconnect_script(
+            keys=self.keys(user_id),
+            args=[sid, time.time(), ttl, uuid.uuid4().hex])
+        return token.decode('utf-8') if token is not None else None
+
+    def expire(self, user_id, token):
+        return self.expire_script(keys=self.keys(user_id)[1:],
+                                  args=[token]) == 1
+
+
+def get_backend():
+    """Return the presence backend of the current application, creating it
+    if necessary. The PRESENCE_BACKEND configuration variable is set to
+    "memory", or to the URL of a Redis server.
+    """
+    backend = current_app.extensions.get('presence')
+    if backend is None:
+        url = current_app.config['PRESENCE_BACKEND']
+        if url == 'memory':
+            backend = MemoryBackend()
+        else:
+            backend = RedisBackend(url)
+        current_app.extensions['presence'] = backend
+    return backend
+
+
+def connect(user_id, sid):
+    """Record a connection of the user. This is called for each event that
+    the connection sends with the user token, to keep it from expiring.
+    """
+    get_backend().connect(user_id, sid, current_app.config['PRESENCE_TTL'])
+
+
+def disconnect(user_id, sid):
+    """Remove a connection of the user, and mark the user offline after the
+    grace period if it was the last one.
+    """
+    token = get_backend().disconnect(user_id, sid,
+                                     current_app.config['PRESENCE_TTL'])
+    if token is None:
+        return
+    grace_period = current_app.config['PRESENCE_GRACE_PERIOD']
+    if not grace_period:
+        expire(user_id, token)
+        return
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                expire(user_id, token)
+            except Exception:
+                logger.exception('Could not mark user %s offline', user_id)
+            finally:
+                db.session.remove()
+
+    timer = threading.Timer(grace_period, run)
+    timer.daemon = True
+    timer.start()
+
+
+def expire(user_id, token):
+    """Mark the user offline, unless a connection was made during the grace
+    period.
+    """
+    if not get_backend().expire(user_id, token):
+        return
+    user = User.query.get(user_id)
+    if user is not None and user.online:
+        user.online = False
+        sqlite.save(user, 'online')
+        from .events import push_model
+        push_model(user)
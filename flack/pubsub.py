@@ -0,0 +1,121 @@
+"""Socket.IO message queue for deployments where all the processes run on the
+same host, which does not need Redis or any other external service.
+
+The message queue URL has the form "unix:///path/to/directory". Each process
+that has Socket.IO clients binds a Unix datagram socket in that directory,
+and a process that emits sends the message to all the sockets found there,
+including its own. Celery workers and other processes that only emit do not
+bind a socket. The sockets of processes that ended without removing them are
+deleted the first time a message cannot be delivered to them.
+
+Any process that can write to the directory can inject events, so it is
+created private to the user that runs the server, and the manager refuses to
+start with a directory that other users own or can write to.
+"""
+import errno
+import logging
+import os
+import pickle
+import socket
+import stat
+import uuid
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# Largest message that can be sent. Messages are pickled emit requests, so
+# this is mostly taken by the data of the event. A datagram has to fit in the
+# send buffer of the socket, which is 208KB by default on Linux, so the limit
+# is kept below that, and the buffer is also enlarged where the system allows
+# it.
+MAX_MESSAGE_SIZE = 192 * 1024
+
+
+def check_directory(path):
+    """Raise RuntimeError if the directory is owned by another user, or if
+    its group or other users can write to it.
+    """
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError('{} is not a directory'.format(path))
+    if st.st_uid != os.getuid():
+        raise RuntimeError('{} is owned by another user'.format(path))
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError('{} can be written by other users'.format(path))
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """Client manager that sends messages between processes through Unix
+    datagram sockets.
+    """
+    name = 'unix'
+
+    def __init__(self, url, channel='socketio', write_only=False,
+                 logger=None, send_timeout=1):
+        directory = url[len('unix://'):]
+        self.path = os.path.join(directory, channel)
+        for path in (directory, self.path):
+            try:
+                os.makedirs(path, 0o700)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            check_directory(path)
+        self.address = None
+        self.send_timeout = send_timeout
+        self.sender = None
+        super(UnixSocketManager, self).__init__(
+            channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        if self.sender is None:
+            self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # a process that is not reading its messages must not stop the
+            # others from emitting
+            self.sender.settimeout(self.send_timeout)
+            self.sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                   2 * MAX_MESSAGE_SIZE)
+        message = pickle.dumps(data)
+        if len(message) > MAX_MESSAGE_SIZE:
+            logger.error('Socket.IO message of %d bytes is too large',
+                         len(message))
+            return
+        for name in os.listdir(self.path):
+            address = os.path.join(self.path, name)
+            try:
+                self.sender.sendto(message, address)
+            except socket.timeout:
+                logger.warning('Timed out sending to %s', address)
+            except socket.error as exc:
+                if exc.errno == errno.EMSGSIZE:
+                    # the message does not fit in the send buffer, so it
+                    # cannot be sent to any of the sockets
+                    logger.error('Socket.IO message of %d bytes does not fit '
+                                 'in the socket buffer', len(message))
+                    return
+                if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # the process that owned this socket is gone
+                    try:
+                        os.unlink(address)
+                    except OSError:
+                        pass
+                else:
+                    logger.exception('Could not send to %s', address)
+
+    def _listen(self):
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.address = os.path.join(self.path, '{}-{}.sock'.format(
+            os.getpid(), uuid.uuid4().hex[:8]))
+        receiver.bind(self.address)
+        buffer = bytearray(MAX_MESSAGE_SIZE)
+        try:
+            while True:
+                size = receiver.recv_into(buffer)
+                yield bytes(buffer[:size])
+        finally:
+            receiver.close()
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
@@ -0,0 +1,265 @@
+from functools import wraps
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, request
+
+from . import celery, stats
+from .tasks import get_executor
+
+logger = logging.getLogger(__name__)
+
+# Result of the last Celery queue depth check, as a (check time, depth) tuple
+last_depth_check = (0, 0)
+
+
+class MemoryBackend(object):
+    """Token buckets stored in the memory of the process. Each process
+    enforces the limits on its own, so with multiple servers the effective
+    limits are multiplied by the number of processes. When there are
+    max_keys buckets, those that have refilled completely are removed, and
+    if that does not make room, the least recently used one is.
+    """
+    def __init__(self, max_keys=10000):
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1):
+        """Take tokens from a bucket that is refilled with rate tokens per
+        second and holds up to burst tokens. Return 0 if the tokens were
+        available, or else the number of seconds until they will be.
+        """
+        now = time.time()
+        with self.lock:
+            tokens, updated_at, _, _ = self.buckets.pop(
+                key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            retry_after = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / float(rate)
+            if len(self.buckets) >= self.max_keys:
+                self.prune(now)
+                while len(self.buckets) >= self.max_keys:
+                    self.buckets.popitem(last=False)
+            # the bucket is moved to the end, which keeps the buckets in
+            # order of use
+            self.buckets[key] = (tokens, now, rate, burst)
+        return retry_after
+
+    def prune(self, now):
+        # remove the buckets that have refilled completely, as they are in
+        # the same state as a bucket that does not exist
+        for key, (tokens, updated_at, rate, burst) in list(
+                self.buckets.items()):
+            if tokens + (now - updated_at) * rate >= burst:
+                del self.buckets[key]
+
+
+class RedisBackend(object):
+    """Token buckets stored in Redis, shared by all the processes that use
+    the same Redis server.
+    """
+    script = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+           'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+'''
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.consume_script = self.redis.register_script(self.script)
+
+    def consume(self, key, rate, burst, cost=1):
+        return float(self.consume_script(
+            keys=['flack:ratelimit:' + key],
+            args=[rate, burst, time.time(), cost]))
+
+
+def get_backend():
+    """Return the rate limit backend of the current application, creating it
+    if necessary. The RATELIMIT_BACKEND configuration variable is set to
+    "memory", or to the URL of a Redis server.
+    """
+    backend = current_app.extensions.get('ratelimit')
+    if backend is None:
+        url = current_app.config['RATELIMIT_BACKEND']
+        if url == 'memory':
+            backend = MemoryBackend()
+        else:
+            backend = RedisBackend(url)
+        current_app.extensions['ratelimit'] = backend
+    return backend
+
+
+def queue_depth():
+    """Return the number of background tasks waiting to run. The queue of the
+    in-process executor is checked directly. The depth of the Celery queue is
+    cached for SHED_CHECK_INTERVAL seconds.
+    """
+    global last_depth_check
+    executor = get_executor()
+    if executor is not None:
+        return executor.queue.qsize()
+    checked_at, depth = last_depth_check
+    now = time.time()
+    if now - checked_at < current_app.config['SHED_CHECK_INTERVAL']:
+        return depth
+    try:
+        with celery.connection_or_acquire() as conn:
+            depth = conn.default_channel.queue_declare(
+                queue=celery.conf.task_default_queue,
+                passive=True).message_count
+    except Exception:
+        logger.exception('Could not check the Celery queue depth')
+        depth = 0
+    last_depth_check = (now, depth)
+    return depth
+
+
+def overloaded():
+    """Return True if the server should reject expensive work, because the
+    task queue is too long or the database is responding slowly.
+    """
+    max_depth = current_app.config['SHED_MAX_QUEUE_DEPTH']
+    if max_depth is not None and queue_depth() > max_depth:
+        return True
+    max_latency = current_app.config['SHED_MAX_SQL_LATENCY']
+    if max_latency is not None and stats.sql_latency() > max_latency:
+        return True
+    return False
+
+
+def consume(name, scope, key):
+    """Consume a token from the bucket of the given rule and scope. Return
+    None if the operation can proceed, or else a (status code, retry after)
+    tuple.
+    """
+    rule = current_app.config['RATELIMITS'].get(name, {})
+    if scope not in rule:
+        return None
+    rate, burst = rule[scope]
+    retry_after = get_backend().consume(
+        '{}:{}:{}'.format(name, scope, key), rate, burst)
+    if retry_after > 0:
+        return 429, retry_after
+    return None
+
+
+def check(name):
+    """Apply load shedding and the per IP address rate limits of the given
+    rule to the current client. Return None if the operation can proceed, or
+    else a (status code, retry after) tuple.
+    """
+    if not current_app.config['RATELIMIT_ENABLED']:
+        return None
+    if overloaded():
+        return 503, current_app.config['SHED_CHECK_INTERVAL']
+    return consume(name, 'ip', request.remote_addr or '')
+
+
+def check_token(name, token):
+    """Apply the per token rate limits of the given rule. The token must have
+    been verified, so that clients cannot fill the backend with buckets for
+    made up tokens. Return None if the operation can proceed, or else a
+    (status code, retry after) tuple.
+    """
+    if not current_app.config['RATELIMIT_ENABLED']:
+        return None
+    # tokens are hashed, so that they are not stored in clear text
+    return consume(name, 'token',
+                   hashlib.sha1(token.encode('utf-8')).hexdigest())
+
+
+def error_response(rv):
+    """Return the response for a request rejected by check() or
+    check_token().
+    """
+    status_code, retry_after = rv
+    return (jsonify({'error': 'too many requests' if status_code == 429
+                     else 'service unavailable'}),
+            status_code,
+            {'Retry-After': str(int(math.ceil(retry_after)))})
+
+
+def error_ack(rv):
+    """Return the acknowledgement for a Socket.IO event rejected by check()
+    or check_token().
+    """
+    status_code, retry_after = rv
+    return {'status': status_code, 'retry_after': int(math.ceil(retry_after))}
+
+
+def limit(name):
+    """Decorator that applies load shedding and the per IP address rate
+    limits to a route. It must be applied before authentication, so that
+    rejected requests do not reach the database.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            # requests that run in Celery were already checked
+            if not getattr(g, 'in_celery', False):
+                rv = check(name)
+                if rv is not None:
+                    return error_response(rv)
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def limit_token(name):
+    """Decorator that applies the per token rate limits to a route. It must
+    be applied after token authentication.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            # requests that run in Celery were already checked
+            if not getattr(g, 'in_celery', False):
+                auth = request.headers.get('Authorization', '')
+                rv = check_token(name, auth.split(None, 1)[-1])
+                if rv is not None:
+                    return error_response(rv)
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def limit_event(name):
+    """Decorator that applies load shedding and the per IP address rate
+    limits to a Socket.IO event. Rejected events are acknowledged with an
+    error. The per token limits are applied by the event handler, with
+    check_token(), once it has verified the token.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            rv = check(name)
+            if rv is not None:
+                return error_ack(rv)
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -0,0 +1,143 @@
+import threading
+import time
+
+from flask import current_app, g
+from sqlalchemy import inspect
+
+from . import db
+from .models import User, Message
+
+# Result of the last replica lag check, as a (check time, lag) tuple
+last_lag_check = (0, 0)
+
+
+class MemoryWrites(object):
+    """Recent writes stored in the memory of the process. This only works
+    when all the requests of a user are handled by a single process.
+    """
+    def __init__(self):
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def mark(self, user_id, window):
+        """Record that the user wrote to the database."""
+        now = time.time()
+        with self.lock:
+            for id in [id for id, t in self.writes.items()
+                       if t < now - window]:
+                del self.writes[id]
+            self.writes[user_id] = now
+
+    def wrote_recently(self, user_id, window):
+        """Return True if the user wrote during the last window seconds."""
+        t = self.writes.get(user_id)
+        return t is not None and t >= time.time() - window
+
+
+class RedisWrites(object):
+    """Recent writes stored in Redis, shared by all the processes that use
+    the same Redis server. Each write is a key that expires at the end of
+    the staleness window.
+    """
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def mark(self, user_id, window):
+        self.redis.set('flack:replica:write:{}'.format(user_id), 1,
+                       px=int(window * 1000))
+
+    def wrote_recently(self, user_id, window):
+        return bool(self.redis.exists(
+            'flack:replica:write:{}'.format(user_id)))
+
+
+def get_writes():
+    """Return the store of recent writes of the current application,
+    creating it if necessary. The REPLICA_WRITES_BACKEND configuration
+    variable is set to "memory", or to the URL of a Redis server.
+    """
+    writes = current_app.extensions.get('replica_writes')
+    if writes is None:
+        url = current_app.config['REPLICA_WRITES_BACKEND']
+        if url == 'memory':
+            writes = MemoryWrites()
+        else:
+            writes = RedisWrites(url)
+        current_app.extensions['replica_writes'] = writes
+    return writes
+
+
+def init_app(app):
+    """Configure the read replica, if one is given in the configuration.
+    This needs to be called before the database is initialized.
+    """
+    uri = app.config['SQLALCHEMY_REPLICA_URI']
+    if uri:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds['replica'] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def mark_write(user):
+    """Record that a user has written to the database, so that the reads
+    issued on behalf of this user during the staleness window are sent to
+    the primary database and see the changes.
+    """
+    if not current_app.config['SQLALCHEMY_REPLICA_URI']:
+        return
+    # the id is taken from the identity key, as the user instance is likely
+    # to be expired after a commit and reading the id would reload it
+    get_writes().mark(inspect(user).identity[0],
+                      current_app.config['REPLICA_MAX_STALENESS'])
+
+
+def wrote_recently(user):
+    return get_writes().wrote_recently(
+        inspect(user).identity[0], current_app.config['REPLICA_MAX_STALENESS'])
+
+
+def replica_lag():
+    """Return how far behind the primary the replica is, in seconds.
+
+    The lag is estimated by comparing the most recent update times of the
+    users and of the messages in the two databases, and taking the largest
+    difference. The users change constantly, as their last seen times are
+    updated, so this also detects a replica that stopped applying changes
+    while no messages were being posted. The result is cached for
+    REPLICA_CHECK_INTERVAL seconds, so that the check does not add queries
+    to every request.
+    """
+    global last_lag_check
+    checked_at, lag = last_lag_check
+    now = time.time()
+    if now - checked_at < current_app.config['REPLICA_CHECK_INTERVAL']:
+        return lag
+    query = db.select([
+        db.select([db.func.max(User.updated_at)]).as_scalar(),
+        db.select([db.func.max(Message.updated_at)]).as_scalar()])
+    primary = db.session.execute(query).first()
+    replica = db.session.execute(
+        query, bind=db.get_engine(current_app, 'replica')).first()
+    lag = max([max((p or 0) - (r or 0), 0)
+               for p, r in zip(primary, replica)])
+    last_lag_check = (now, lag)
+    return lag
+
+
+def read_bind():
+    """Return the engine that a read-only query should use.
+
+    The replica is used when it is configured, its lag is within the
+    staleness window, and the current user has not written anything during
+    that window. In all other cases None is returned, which makes the
+    session use the primary database.
+    """
+    if not current_app.config['SQLALCHEMY_REPLICA_URI']:
+        return None
+    user = g.get('current_user')
+    if user is not None and wrote_recently(user):
+        return None
+    if replica_lag() > current_app.config['REPLICA_MAX_STALENESS']:
+        return None
+    return db.get_engine(current_app, 'replica')
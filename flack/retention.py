@@ -0,0 +1,75 @@
+from flask import current_app
+
+from . import db, celery, search
+from .models import Message, ArchivedMessage
+from .utils import timestamp
+
+
+def archive_messages(max_age=None, batch_size=None, max_batches=None):
+    """Move the messages that were not updated in the last max_age seconds
+    to the archive table, and return how many were moved.
+
+    The messages are moved in batches of batch_size, each in its own
+    transaction, so that the database is never locked for long. At most
+    max_batches are moved in a single run, the rest are left for the next
+    run. The arguments default to the RETENTION_* configuration variables.
+    """
+    config = current_app.config
+    if max_age is None:
+        max_age = config['RETENTION_MAX_AGE']
+    if batch_size is None:
+        batch_size = config['RETENTION_BATCH_SIZE']
+    if max_batches is None:
+        max_batches = config['RETENTION_MAX_BATCHES']
+    cutoff = timestamp() - max_age
+
+    # the message with the highest id is never archived, because SQLite
+    # would reuse its id for the next message
+    last_id = db.session.execute(
+        db.select([db.func.max(Message.id)])).scalar()
+    if last_id is None:
+        return 0
+    columns = ['id', 'created_at', 'updated_at', 'source', 'html', 'user_id']
+    moved = 0
+    for i in range(max_batches):
+        ids = [row.id for row in db.session.execute(
+            db.select([Message.id]).where(Message.updated_at < cutoff).where(
+                Message.id < last_id).order_by(Message.id).limit(batch_size))]
+        if not ids:
+            break
+        values = [Message.__table__.c[column] for column in columns]
+        values.append(db.literal(timestamp()))
+        db.session.execute(ArchivedMessage.__table__.insert().from_select(
+            columns + ['archived_at'],
+            db.select(values).where(Message.id.in_(ids))))
+        db.session.execute(Message.__table__.delete().where(
+            Message.id.in_(ids)))
+        search.get_backend().remove(db.session.connection(), ids)
+        db.session.commit()
+        moved += len(ids)
+    if moved:
+        # compact the search index after the deletions
+        search.get_backend().optimize(db.session.connection())
+        db.session.commit()
+    return moved
+
+
+def get_archived_message(id, bind=None):
+    """Return an archived message as a row of ArchivedMessage.select(), or
+    None if it does not exist.
+    """
+    return db.session.execute(ArchivedMessage.select().where(
+        ArchivedMessage.id == id), bind=bind).first()
+
+
+@celery.task
+def archive_old_messages():
+    """Celery task that runs the retention job. It is scheduled to run
+    periodically by "celery beat".
+    """
+    from .wsgi_aux import app
+    with app.app_context():
+        archive_messages()
+
+        # clean up the database session
+        db.session.remove()
@@ -0,0 +1,241 @@
+import importlib
+import logging
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, object_session
+
+from . import db
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# URLs of the databases that are known to have the FTS5 index table
+fts5_databases = set()
+
+
+class SearchBackend(object):
+    """Base class for message search backends.
+
+    A backend keeps an index of the message sources up to date as messages
+    are written, and returns the ids of the messages that match a query,
+    best matches first. The index is updated at the end of each session
+    flush, on the same connection, so the changes are committed or rolled
+    back together with the messages.
+
+    The base class has no index, and searches by scanning the messages table
+    with LIKE, which works with any database.
+    """
+    def create(self, connection):
+        """Create the index, if the backend needs one."""
+        pass
+
+    def drop(self, connection):
+        """Delete the index."""
+        pass
+
+    def index(self, connection, messages):
+        """Add messages, given as a list of (id, source) tuples, to the
+        index.
+        """
+        pass
+
+    def remove(self, connection, ids):
+        """Remove the messages with the given ids from the index."""
+        pass
+
+    def rebuild(self, connection):
+        """Index all the messages in the database from scratch."""
+        pass
+
+    def optimize(self, connection):
+        """Compact the index after a large number of changes."""
+        pass
+
+    def search(self, query, limit, offset=0, bind=None):
+        """Return the ids of the messages that match the query."""
+        q = db.select([Message.id])
+        for term in query.split():
+            term = term.replace('\\', '\\\\').replace('%', '\\%').replace(
+                '_', '\\_')
+            q = q.where(Message.source.like('%' + term + '%', escape='\\'))
+        q = q.order_by(Message.id.desc()).limit(limit).offset(offset)
+        return [row.id for row in db.session.execute(q, bind=bind)]
+
+
+class LikeSearchBackend(SearchBackend):
+    """Search backend that scans the messages table with LIKE. It does not
+    need an index, so it works with any database, but its cost grows with
+    the size of the table. Results are sorted from newest to oldest.
+    """
+    pass
+
+
+class FTS5SearchBackend(SearchBackend):
+    """Search backend that uses an SQLite FTS5 full-text index. Results are
+    ranked with the BM25 algorithm of FTS5.
+
+    If SQLite was built without FTS5, the index is not created, and searches
+    fall back to LIKE.
+    """
+    table = 'messages_fts'
+    module = 'fts5'
+
+    def has_index(self, connection):
+        # only a positive result is cached, so that an index created while
+        # the application is running starts to be updated right away
+        url = str(connection.engine.url)
+        if url not in fts5_databases:
+            if connection.execute('SELECT 1 FROM sqlite_master WHERE '
+                                  'name = ?', (self.table,)).first() is None:
+                return False
+            fts5_databases.add(url)
+        return True
+
+    def create(self, connection):
+        try:
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING '
+                               '{}(source)'.format(self.table, self.module))
+        except OperationalError:
+            logger.warning('Could not create the FTS5 index, messages will '
+                           'be searched with LIKE', exc_info=True)
+            return
+        fts5_databases.add(str(connection.engine.url))
+
+    def drop(self, connection):
+        connection.execute('DROP TABLE IF EXISTS {}'.format(self.table))
+        fts5_databases.discard(str(connection.engine.url))
+
+    def index(self, connection, messages):
+        if self.has_index(connection):
+            connection.execute('INSERT INTO {} (rowid, source) VALUES '
+                               '(?, ?)'.format(self.table), messages)
+
+    def remove(self, connection, ids):
+        if self.has_index(connection):
+            connection.execute('DELETE FROM {} WHERE rowid IN ({})'.format(
+                self.table, ', '.join(['?'] * len(ids))), tuple(ids))
+
+    def rebuild(self, connection):
+        self.drop(connection)
+        self.create(connection)
+        if not self.has_index(connection):
+            return
+        connection.execute('INSERT INTO {} (rowid, source) SELECT id, source '
+                           'FROM messages'.format(self.table))
+
+    def optimize(self, connection):
+        if self.has_index(connection):
+            connection.execute("INSERT INTO {0} ({0}) VALUES "
+                               "('optimize')".format(self.table))
+
+    def search(self, query, limit, offset=0, bind=None):
+        connection = db.session.connection(mapper=inspect(Message), bind=bind)
+        if not self.has_index(connection):
+            return super(FTS5SearchBackend, self).search(
+                query, limit, offset=offset, bind=bind)
+        # each word is quoted, so that characters with a special meaning in
+        # the FTS5 query syntax are matched literally
+        terms = ['"' + term.replace('"', '""') + '"'
+                 for term in query.split()]
+        if not terms:
+            return []
+        rows = db.session.execute(
+            'SELECT rowid FROM {0} WHERE {0} MATCH :query ORDER BY rank '
+            'LIMIT :limit OFFSET :offset'.format(self.table),
+            {'query': ' '.join(terms), 'limit': limit, 'offset': offset},
+            bind=bind)
+        return [row[0] for row in rows]
+
+
+def get_backend():
+    """Return the search backend of the current application, creating it if
+    necessary.
+
+    The SEARCH_BACKEND configuration variable can be set to "fts5" or "like",
+    or to "<module>:<class>" to use a custom SearchBackend subclass. If it
+    is not set, FTS5 is used with SQLite databases, and LIKE with all others.
+    """
+    backend = current_app.extensions.get('search')
+    if backend is None:
+        name = current_app.config['SEARCH_BACKEND']
+        if name is None:
+            uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+            name = 'fts5' if uri.startswith('sqlite:') else 'like'
+        if name == 'fts5':
+            backend = FTS5SearchBackend()
+        elif name == 'like':
+            backend = LikeSearchBackend()
+        else:
+            module, cls = name.split(':', 1)
+            backend = getattr(importlib.import_module(module), cls)()
+        current_app.extensions['search'] = backend
+    return backend
+
+
+def search(query, limit, offset=0, bind=None):
+    """Return the messages that match the query, best matches first, as rows
+    of the query in Message.select().
+    """
+    ids = get_backend().search(query, limit, offset=offset, bind=bind)
+    if not ids:
+        return []
+    rows = {row.id: row for row in db.session.execute(
+        Message.select().where(Message.id.in_(ids)), bind=bind)}
+    return [rows[id] for id in ids if id in rows]
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def on_create(target, connection, **kwargs):
+    if has_app_context():
+        get_backend().create(connection)
+
+
+@event.listens_for(Message.__table__, 'after_drop')
+def on_drop(target, connection, **kwargs):
+    if has_app_context():
+        get_backend().drop(connection)
+
+
+def pending_changes(target):
+    """Return the index changes waiting for the end of the flush of the
+    session that the message belongs to, as an (added, removed) tuple.
+    """
+    return object_session(target).info.setdefault('search_index', ([], []))
+
+
+@event.listens_for(Message, 'after_insert')
+def on_insert(mapper, connection, target):
+    pending_changes(target)[0].append((target.id, target.source))
+
+
+@event.listens_for(Message, 'after_update')
+def on_update(mapper, connection, target):
+    # the index only needs to change when the source attribute was set,
+    # which is also what triggers Message.on_changed_source
+    if inspect(target).attrs.source.history.has_changes():
+        added, removed = pending_changes(target)
+        removed.append(target.id)
+        added.append((target.id, target.source))
+
+
+@event.listens_for(Message, 'after_delete')
+def on_delete(mapper, connection, target):
+    pending_changes(target)[1].append(target.id)
+
+
+@event.listens_for(Session, 'after_flush')
+def on_flush(session, flush_context):
+    """Write the index changes of all the messages in the flush with one
+    statement for each type of change.
+    """
+    added, removed = session.info.pop('search_index', ([], []))
+    if not has_app_context() or not (added or removed):
+        return
+    connection = session.connection(mapper=inspect(Message))
+    backend = get_backend()
+    if removed:
+        backend.remove(connection, removed)
+    if added:
+        backend.index(connection, added)
@@ -0,0 +1,143 @@
+import threading
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import db
+from .batch import Batcher
+from .utils import timestamp
+
+
+def init_app(app):
+    """Configure a file based SQLite database for concurrent use. The
+    pragmas given in SQLITE_PRAGMAS are set on every new connection, and if
+    SQLITE_WRITER is enabled a serialized writer is attached to the
+    application.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not uri.startswith('sqlite:') or uri in ('sqlite://', 'sqlite:///') \
+            or ':memory:' in uri:
+        return
+    engine = db.get_engine(app)
+    pragmas = app.config['SQLITE_PRAGMAS']
+    if pragmas:
+        event.listen(engine, 'connect', lambda dbapi_connection, record:
+                     set_pragmas(dbapi_connection, pragmas))
+    if app.config['SQLITE_WRITER']:
+        app.extensions['sqlite_writer'] = WriteQueue(
+            engine, batch_size=app.config['SQLITE_WRITER_BATCH_SIZE'],
+            max_delay=app.config['SQLITE_WRITER_MAX_DELAY'])
+
+
+def set_pragmas(dbapi_connection, pragmas):
+    """Set the given pragmas on a raw SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in sorted(pragmas.items()):
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+def get_writer():
+    """Return the serialized writer of the current application, or None if
+    it is not enabled.
+    """
+    return current_app.extensions.get('sqlite_writer')
+
+
+def save(models, *fields):
+    """Write the given attributes of one or more models to the database.
+
+    If the serialized writer is enabled, an UPDATE statement for each model
+    with changes in the given attributes is sent to it, and the attributes
+    are then marked as committed in the session, so that they are not
+    written a second time. Like the session, the writer skips the models
+    that did not change, and does not move their updated_at timestamp. Else
+    the models are committed through the session as usual.
+    """
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+    writer = get_writer()
+    if writer is None:
+        db.session.add_all(models)
+        db.session.commit()
+        return
+    updates = []
+    for model in models:
+        state = inspect(model)
+        changed = [field for field in fields
+                   if state.attrs[field].history.has_changes()]
+        if not changed:
+            continue
+        table = model.__table__
+        values = {field: getattr(model, field) for field in changed}
+        if 'updated_at' in table.c:
+            values['updated_at'] = timestamp()
+        updates.append((model, values, writer.submit(
+            table.update().where(table.c.id == model.id).values(**values))))
+    for model, values, write in updates:
+        write.wait()
+        for field, value in values.items():
+            set_committed_value(model, field, value)
+
+
+class Write(object):
+    """A statement waiting to be executed by the writer."""
+    def __init__(self, statement):
+        self.statement = statement
+        self.result = None
+        self.exception = None
+        self.event = threading.Event()
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class WriteQueue(Batcher):
+    """Serialized database writer.
+
+    Statements given to execute() are queued and run by a single background
+    thread, which groups all the statements that arrive within max_delay
+    seconds (up to batch_size of them) into one transaction. This removes
+    lock contention between threads of the process, and replaces many small
+    commits with a few larger ones.
+    """
+    def __init__(self, engine, batch_size=100, max_delay=0.005):
+        super(WriteQueue, self).__init__(self.write, max_size=batch_size,
+                                         max_delay=max_delay)
+        self.engine = engine
+        self.commits = 0
+
+    def submit(self, statement):
+        """Queue a write statement. The wait() method of the returned object
+        blocks until the statement is committed.
+        """
+        write = Write(statement)
+        self.add(write)
+        return write
+
+    def execute(self, statement):
+        """Execute a write statement and wait until it is committed."""
+        return self.submit(statement).wait()
+
+    def write(self, batch):
+        try:
+            with self.engine.begin() as conn:
+                results = [conn.execute(write.statement) for write in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].exception = e
+                batch[0].event.set()
+            else:
+                # retry each statement on its own, so that a bad one does not
+                # fail the others in the group
+                for write in batch:
+                    self.write([write])
+            return
+        self.commits += 1
+        for write, result in zip(batch, results):
+            write.result = result
+            write.event.set()
@@ -2,6 +2,108 @@
 
 var app = app || {};
 
+// Field names of the models in binary updated_model events, indexed by class.
+// This must match the SCHEMAS list in flack/packing.py.
+app.packedSchemas = [
+    ['User', ['id', 'created_at', 'updated_at', 'nickname', 'last_seen_at',
+              'online']],
+    ['Message', ['id', 'created_at', 'updated_at', 'source', 'html',
+                 'user_id']]
+];
+
+// Decode a msgpack buffer. Only the types that the server sends are
+// supported: nil, booleans, numbers, strings, arrays and maps.
+app.unpack = function(buffer) {
+    var view = new DataView(buffer);
+    var bytes = new Uint8Array(buffer);
+    var decoder = new TextDecoder('utf-8');
+    var pos = 0;
+
+    function uint(size) {
+        var value;
+        if (size == 1) value = view.getUint8(pos);
+        else if (size == 2) value = view.getUint16(pos);
+        else if (size == 4) value = view.getUint32(pos);
+        else value = view.getUint32(pos) * 4294967296 + view.getUint32(pos + 4);
+        pos += size;
+        return value;
+    }
+    function int(size) {
+        var value;
+        if (size == 1) value = view.getInt8(pos);
+        else if (size == 2) value = view.getInt16(pos);
+        else if (size == 4) value = view.getInt32(pos);
+        else value = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4);
+        pos += size;
+        return value;
+    }
+    function str(length) {
+        var value = decoder.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+    function array(length) {
+        var value = [];
+        for (var i = 0; i < length; i++) {
+            value.push(next());
+        }
+        return value;
+    }
+    function map(length) {
+        var value = {};
+        for (var i = 0; i < length; i++) {
+            var key = next();
+            value[key] = next();
+        }
+        return value;
+    }
+    function next() {
+        var type = uint(1);
+        var value;
+        if (type < 0x80) return type;
+        if (type < 0x90) return map(type & 0x0f);
+        if (type < 0xa0) return array(type & 0x0f);
+        if (type < 0xc0) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+            case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+            case 0xcc: return uint(1);
+            case 0xcd: return uint(2);
+            case 0xce: return uint(4);
+            case 0xcf: return uint(8);
+            case 0xd0: return int(1);
+            case 0xd1: return int(2);
+            case 0xd2: return int(4);
+            case 0xd3: return int(8);
+            case 0xd9: return str(uint(1));
+            case 0xda: return str(uint(2));
+            case 0xdb: return str(uint(4));
+            case 0xdc: return array(uint(2));
+            case 0xdd: return array(uint(4));
+            case 0xde: return map(uint(2));
+            case 0xdf: return map(uint(4));
+        }
+        throw new Error('Unsupported msgpack type ' + type);
+    }
+    return next();
+};
+
+// Convert a binary updated_model event to the format of the JSON events.
+app.unpackModel = function(buffer) {
+    var packed = app.unpack(buffer);
+    var schema = app.packedSchemas[packed[0]];
+    var model = _.object(schema[1], packed[1]);
+    var data = {'class': schema[0], 'model': model};
+    if (packed[2]) {
+        data.meta = {trace_id: packed[2]};
+    }
+    return data;
+};
+
 $(function() {
     // Create the models.
     app.userList = new app.UserList();
@@ -14,9 +116,14 @@ $(function() {
     app.loginFormView = new app.LoginFormView({model: app.token});
     app.postFormView = new app.PostFormView({model: app.token});
 
-    // Create the Socket.IO client that will update messages and users
-    app.socket = io.connect(location.protocol + '//' + location.hostname + ':' + location.port);
+    // Create the Socket.IO client that will update messages and users. The
+    // server sends binary events if it has them enabled, or else JSON.
+    var query = window.TextDecoder ? {query: 'encoding=msgpack'} : {};
+    app.socket = io.connect(location.protocol + '//' + location.hostname + ':' + location.port, query);
     app.socket.on('updated_model', function(data) {
+        if (data instanceof ArrayBuffer) {
+            data = app.unpackModel(data);
+        }
         if (data['class'] == 'User') {
             var user = new app.User();
             user.set(data.model);
@@ -29,6 +136,16 @@ $(function() {
         }
     });
 
+    // After reconnecting, for example to a restarted server, ping the user
+    // right away, so that the new connection is counted before the grace
+    // period of the old one ends
+    app.socket.on('reconnect', function() {
+        var token = app.token.get('token');
+        if (token) {
+            app.socket.emit('ping_user', token);
+        }
+    });
+
     // While the user is logged in, periodically ping it on the server
     app.token.on('change:token', function() {
         // first clear the timer for the old token
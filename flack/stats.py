@@ -1,9 +1,52 @@
-from flask import current_app
+from functools import wraps
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from .utils import timestamp
 
 # We use a list to calculate requests per second
 request_stats = []
 
+# Accumulated metrics for each endpoint and Socket.IO event, indexed by a
+# (kind, name) tuple
+metrics = {}
+metrics_lock = threading.Lock()
+
+# Moving average of the SQL statement execution time, and the time of the
+# last update, as a (latency, updated at) tuple
+recent_sql_latency = (0.0, 0)
+
+
+class Metric(object):
+    """Accumulated totals for an endpoint or event."""
+    __slots__ = ('count', 'time', 'max_time', 'sql_count', 'sql_time',
+                 'enqueue_count', 'enqueue_time', 'emit_count')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Operation(object):
+    """Counters for the request or event that is currently running."""
+    __slots__ = ('kind', 'name', 'start', 'sql_count', 'sql_time',
+                 'enqueue_count', 'enqueue_time', 'emit_count', 'parent')
+
+    def __init__(self, kind, name, parent=None):
+        self.kind = kind
+        self.name = name
+        self.start = time.time()
+        self.sql_count = self.emit_count = self.enqueue_count = 0
+        self.sql_time = self.enqueue_time = 0.0
+        self.parent = parent
+
 
 def add_request():
     t = timestamp()
@@ -15,3 +58,139 @@ def add_request():
 
 def requests_per_second():
     return len(request_stats) / current_app.config['REQUEST_STATS_WINDOW']
+
+
+def current_operation():
+    """Return the operation running in the current context, or None."""
+    if not has_app_context():
+        return None
+    return g.get('stats_operation')
+
+
+def start_operation(kind, name):
+    """Start recording metrics for an endpoint or event."""
+    if not current_app.config['STATS_ENABLED']:
+        return
+    g.stats_operation = Operation(kind, name, current_operation())
+
+
+def end_operation():
+    """Stop recording the current operation and add its metrics to the
+    totals.
+    """
+    op = current_operation()
+    if op is None:
+        return
+    g.stats_operation = op.parent
+    elapsed = time.time() - op.start
+    with metrics_lock:
+        metric = metrics.get((op.kind, op.name))
+        if metric is None:
+            metric = metrics[(op.kind, op.name)] = Metric()
+        metric.count += 1
+        metric.time += elapsed
+        metric.max_time = max(metric.max_time, elapsed)
+        metric.sql_count += op.sql_count
+        metric.sql_time += op.sql_time
+        metric.enqueue_count += op.enqueue_count
+        metric.enqueue_time += op.enqueue_time
+        metric.emit_count += op.emit_count
+
+
+def track_event(name):
+    """Decorator that records metrics for a Socket.IO event handler."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            start_operation('event', name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end_operation()
+        return wrapped
+    return decorator
+
+
+def add_enqueue(start):
+    """Record the time it took to send a task to Celery."""
+    op = current_operation()
+    if op is not None:
+        op.enqueue_count += 1
+        op.enqueue_time += time.time() - start
+
+
+def add_emit():
+    """Record a Socket.IO emit."""
+    op = current_operation()
+    if op is not None:
+        op.emit_count += 1
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context.stats_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    global recent_sql_latency
+    if context is None:
+        return
+    elapsed = time.time() - context.stats_start
+    latency, updated_at = recent_sql_latency
+    recent_sql_latency = (latency + (elapsed - latency) * 0.05, time.time())
+    op = current_operation()
+    if op is not None:
+        op.sql_count += 1
+        op.sql_time += elapsed
+
+
+def sql_latency():
+    """Return the recent average execution time of SQL statements. Samples
+    older than 10 seconds are not considered, so that the average does not
+    remain high when load shedding stops all database activity.
+    """
+    latency, updated_at = recent_sql_latency
+    if updated_at < time.time() - 10:
+        return 0.0
+    return latency
+
+
+def get_metrics():
+    """Return a snapshot of the accumulated metrics."""
+    with metrics_lock:
+        return {key: metric.to_dict() for key, metric in metrics.items()}
+
+
+def prometheus_metrics():
+    """Return the accumulated metrics in the Prometheus text format."""
+    snapshot = get_metrics()
+    series = [
+        ('flack_requests_total', 'counter', 'count',
+         'Number of requests or events handled.'),
+        ('flack_request_seconds_total', 'counter', 'time',
+         'Total time spent handling requests or events.'),
+        ('flack_request_seconds_max', 'gauge', 'max_time',
+         'Slowest request or event handled.'),
+        ('flack_sql_statements_total', 'counter', 'sql_count',
+         'Number of SQL statements executed.'),
+        ('flack_sql_seconds_total', 'counter', 'sql_time',
+         'Total time spent executing SQL statements.'),
+        ('flack_celery_enqueues_total', 'counter', 'enqueue_count',
+         'Number of tasks sent to Celery.'),
+        ('flack_celery_enqueue_seconds_total', 'counter', 'enqueue_time',
+         'Total time spent sending tasks to Celery.'),
+        ('flack_socketio_emits_total', 'counter', 'emit_count',
+         'Number of Socket.IO events emitted.'),
+    ]
+    lines = []
+    for name, type_, field, help_ in series:
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        for (kind, endpoint), metric in sorted(snapshot.items()):
+            lines.append('{}{{kind="{}",name="{}"}} {}'.format(
+                name, kind, endpoint, metric[field]))
+    return '\n'.join(lines) + '\n'
@@ -1,51 +1,96 @@
 from functools import wraps
+import os
+import sys
+import time
 try:
     from io import BytesIO
 except ImportError:  # pragma:  no cover
     from cStringIO import StringIO as BytesIO
 
-from flask import Blueprint, abort, g, request
+from flask import Blueprint, abort, current_app, g, jsonify, request
 from werkzeug.exceptions import InternalServerError
 from celery import states
+from celery.signals import worker_init, worker_process_init
 
-from . import celery
-from .utils import url_for
-
-text_types = (str, bytes)
-try:
-    text_types += (unicode,)
-except NameError:
-    # no unicode on Python 3
-    pass
+from . import celery, stats, tracing
+from .executor import Executor, QueueFull
+from .utils import url_for, string_types
 
 tasks_bp = Blueprint('tasks', __name__)
 
 
+def get_executor():
+    """Return the in-process executor of the current application, creating it
+    if necessary, or None if background tasks run in Celery.
+    """
+    config = current_app.config
+    if config['TASK_BACKEND'] != 'local':
+        return None
+    executor = current_app.extensions.get('executor')
+    if executor is None:
+        executor = current_app.extensions.setdefault('executor', Executor(
+            threads=config['TASK_THREADS'],
+            max_queue=config['TASK_MAX_QUEUE'],
+            result_ttl=config['TASK_RESULT_TTL'],
+            drain_timeout=config['TASK_DRAIN_TIMEOUT']))
+    return executor
+
+
 @celery.task
 def run_flask_request(environ):
     from .wsgi_aux import app
+    return run_request(app, environ)
+
 
+def run_request(app, environ):
+    """Run a request that was deferred by async_task, and return its response
+    as a (body, status code, headers) tuple.
+    """
     if '_wsgi.input' in environ:
         environ['wsgi.input'] = BytesIO(environ['_wsgi.input'])
 
     # Create a request context similar to that of the original request
     # so that the task can have access to flask.g, flask.request, etc.
     with app.request_context(environ):
-        # Record the fact that we are running in the Celery worker now
+        # Record the fact that we are running in the background task now, be
+        # it in a Celery worker or in the in-process executor
         g.in_celery = True
+        tracing.start_trace(environ.get('flack.trace_id'))
 
         # Run the route function and record the response
-        try:
-            rv = app.full_dispatch_request()
-        except:
-            # If we are in debug mode we want to see the exception
-            # Else, return a 500 error
-            if app.debug:
-                raise
-            rv = app.make_response(InternalServerError())
+        with tracing.span('task run_flask_request'):
+            try:
+                rv = app.full_dispatch_request()
+            except:
+                # If we are in debug mode we want to see the exception
+                # Else, return a 500 error
+                if app.debug:
+                    raise
+                rv = app.make_response(InternalServerError())
         return (rv.get_data(), rv.status_code, rv.headers)
 
 
+@worker_init.connect
+def preload_worker(**kwargs):
+    """Create the auxiliary application in the main Celery worker process
+    when preloading is enabled, so that it is shared by the pool processes.
+    """
+    if os.environ.get('FLACK_PRELOAD'):
+        from . import preload
+        from .wsgi_aux import app
+        preload.warm_up(app)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Set up the per-process resources of a preloaded auxiliary
+    application in a Celery pool process.
+    """
+    if 'flack.wsgi_aux' in sys.modules:
+        from . import preload
+        preload.post_fork(sys.modules['flack.wsgi_aux'].app)
+
+
 def async_task(f):
     """
     This decorator transforms a sync route to asynchronous by running it
@@ -63,10 +108,29 @@ def async_task(f):
         # the request object. The request body has to be handled as a special
         # case, since WSGI requires it to be provided as a file-like object.
         environ = {k: v for k, v in request.environ.items()
-                   if isinstance(v, text_types)}
+                   if isinstance(v, string_types + (bytes,))}
         if 'wsgi.input' in request.environ:
             environ['_wsgi.input'] = request.get_data()
-        t = run_flask_request.apply_async(args=(environ,))
+        environ['flack.trace_id'] = tracing.current_trace_id()
+        start = time.time()
+        executor = get_executor()
+        if executor is not None:
+            try:
+                id = executor.submit(run_request, args=(
+                    current_app._get_current_object(), environ))
+            except QueueFull:
+                # too much work is queued already, so the client has to
+                # come back later
+                return (jsonify({'error': 'service unavailable'}), 503,
+                        {'Retry-After': '1'})
+            stats.add_enqueue(start)
+            tracing.record_span('enqueue run_request', start)
+            return '', 202, {'Location': url_for('tasks.get_status', id=id)}
+
+        t = run_flask_request.apply_async(args=(environ,),
+                                          headers=tracing.task_headers())
+        stats.add_enqueue(start)
+        tracing.record_span('enqueue run_flask_request', start)
 
         # Return a 202 response, with a link that the client can use to
         # obtain task status that is based on the Celery task id.
@@ -87,9 +151,17 @@ def get_status(id):
     status code, it means that task hasn't finished yet. Else, the response
     from the task is returned.
     """
-    task = run_flask_request.AsyncResult(id)
-    if task.state == states.PENDING:
+    executor = get_executor()
+    if executor is not None:
+        state, info = executor.status(id)
+    else:
+        task = run_flask_request.AsyncResult(id)
+        state, info = task.state, task.info
+    if state == states.PENDING:
         abort(404)
-    if task.state == states.RECEIVED or task.state == states.STARTED:
+    if state == states.RECEIVED or state == states.STARTED:
         return '', 202, {'Location': url_for('tasks.get_status', id=id)}
-    return task.info
+    if state == states.FAILURE:
+        # the task raised an exception instead of returning a response
+        abort(500)
+    return info
@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from functools import wraps
+import importlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from flask import current_app, g, has_app_context
+
+# Trace sinks, indexed by their TRACE_SINK configuration value
+sinks = {}
+sinks_lock = threading.Lock()
+
+# Trace ids given by clients are accepted if they are hex strings, optionally
+# with the dashes of a UUID, of up to 64 characters
+client_trace_id_re = re.compile(r'^[0-9a-fA-F-]{1,64}$')
+
+
+class FileSink(object):
+    """Trace sink that appends spans to a file, one JSON object per line."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        line = json.dumps(span) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+def get_sink():
+    """Return the sink configured for the current application, or None if
+    tracing is disabled.
+
+    The TRACE_SINK configuration variable can be set to "file:<path>" to
+    write spans to a local file, or to "<module>:<class>" to use a custom
+    sink class, which is instantiated without arguments and must implement
+    a record(span) method.
+    """
+    if not has_app_context():
+        return None
+    name = current_app.config['TRACE_SINK']
+    if not name:
+        return None
+    sink = sinks.get(name)
+    if sink is None:
+        with sinks_lock:
+            sink = sinks.get(name)
+            if sink is None:
+                prefix, arg = name.split(':', 1)
+                if prefix == 'file':
+                    sink = FileSink(arg)
+                else:
+                    sink = getattr(importlib.import_module(prefix), arg)()
+                sinks[name] = sink
+    return sink
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def client_trace_id(trace_id):
+    """Return a trace id received from a client, or None if it is missing
+    or invalid. Trace ids are written to the trace sinks and to task headers,
+    so anything other than a short hex string is rejected.
+    """
+    if trace_id and client_trace_id_re.match(trace_id):
+        return trace_id
+    return None
+
+
+def start_trace(trace_id=None):
+    """Set the trace id for the current context, creating a new one if not
+    given.
+    """
+    g.trace_id = trace_id or new_trace_id()
+    return g.trace_id
+
+
+def current_trace_id():
+    """Return the trace id of the current context, or None."""
+    if not has_app_context():
+        return None
+    return g.get('trace_id')
+
+
+def task_trace_id(request):
+    """Return the trace id from the headers of a Celery task request."""
+    trace_id = getattr(request, 'trace_id', None)
+    if trace_id is None and request.headers:
+        trace_id = request.headers.get('trace_id')
+    return trace_id
+
+
+def task_headers():
+    """Return the Celery headers that carry the current trace id."""
+    return {'trace_id': current_trace_id()}
+
+
+def record_span(name, start, duration=None):
+    """Record a span of the current trace in the configured sink."""
+    sink = get_sink()
+    if sink is None:
+        return
+    if duration is None:
+        duration = time.time() - start
+    sink.record({'trace_id': current_trace_id(), 'span': name,
+                 'start': start, 'duration': duration, 'pid': os.getpid()})
+
+
+@contextmanager
+def span(name):
+    """Context manager that records the enclosed code as a span."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(name, start)
+
+
+def trace_event(name):
+    """Decorator that starts a trace for a Socket.IO event handler."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            previous = current_trace_id()
+            start_trace()
+            try:
+                with span('event ' + name):
+                    return f(*args, **kwargs)
+            finally:
+                g.trace_id = previous
+        return wrapped
+    return decorator
@@ -1,6 +1,14 @@
 import time
 
-from flask import url_for as _url_for, current_app, _request_ctx_stack
+from flask import url_for as _url_for, current_app, _request_ctx_stack, \
+    json, stream_with_context, Response
+
+string_types = (str,)
+try:
+    string_types += (unicode,)
+except NameError:
+    # no unicode on Python 3
+    pass
 
 
 def timestamp():
@@ -22,3 +30,51 @@ def url_for(*args, **kwargs):
         with current_app.test_request_context():
             return _url_for(*args, **kwargs)
     return _url_for(*args, **kwargs)
+
+
+def jsonify_stream(key, query, serializer=None, encoded=False):
+    """
+    jsonify replacement for large collections. The response is a JSON object
+    with a single key that holds a list, same as jsonify would produce, but
+    the rows are fetched from the database in chunks and written to the
+    client as they are serialized, so memory usage does not depend on the
+    number of results. If encoded is True, the serializer returns the JSON
+    text of each item instead of a dictionary.
+    """
+    if serializer is None:
+        serializer = _to_dict
+    chunk_size = current_app.config['JSON_STREAM_CHUNK_SIZE']
+    if hasattr(query, 'yield_per'):
+        query = query.yield_per(chunk_size)
+    elif hasattr(query, 'fetchmany'):
+        # results of Core selects are iterated one row at a time, but the
+        # rows are fetched from the cursor in chunks
+        query = _fetch_chunks(query, chunk_size)
+
+    def generate():
+        yield '{' + json.dumps(key) + ': ['
+        sep = ''
+        for item in query:
+            yield sep + (serializer(item) if encoded
+                         else json.dumps(serializer(item)))
+            sep = ', '
+        yield ']}\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def _to_dict(model):
+    return model.to_dict()
+
+
+def _fetch_chunks(result, chunk_size):
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
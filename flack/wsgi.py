@@ -6,3 +6,19 @@ from flack import create_app
 # "application" (the wsgi default) and also the much shorter and convenient
 # "app".
 application = app = create_app(os.environ.get('FLACK_CONFIG', 'production'))
+
+if os.environ.get('FLACK_PRELOAD'):
+    # The application is loaded in the master process of a forking server,
+    # so the shareable state is built here once, and the per-process
+    # resources are set up again in each worker after the fork. Gunicorn
+    # calls post_fork() from its configuration file, and uWSGI through the
+    # postfork decorator.
+    from flack import preload
+    preload.warm_up(app)
+    try:
+        import uwsgi
+        from uwsgidecorators import postfork
+    except ImportError:
+        pass
+    else:
+        postfork(lambda: preload.post_fork(app, workers=uwsgi.numproc))
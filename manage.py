@@ -3,8 +3,11 @@ import os
 import subprocess
 import sys
 
-import eventlet
-eventlet.monkey_patch()
+if sys.argv[1:2] not in (['import'], ['rerender']):
+    # these commands render messages with a process pool, which does not
+    # work with a monkey patched standard library
+    import eventlet
+    eventlet.monkey_patch()
 
 from flask_script import Manager, Command, Server as _Server, Option
 
@@ -84,6 +87,71 @@ class CeleryWorker(Command):
 manager.add_command("celery", CeleryWorker())
 
 
+class Export(Command):
+    """Exports users, messages and archived messages as NDJSON."""
+    option_list = (
+        Option('-o', '--output', dest='output', default='-',
+               help='output file (default: stdout)'),
+        Option('-c', '--chunk-size', dest='chunk_size', type=int,
+               default=1000, help='number of rows read from the database '
+               'at a time'),
+    )
+
+    def run(self, output, chunk_size):
+        from flack import bulk
+        if output == '-':
+            count = bulk.export_ndjson(sys.stdout, chunk_size=chunk_size)
+        else:
+            with open(output, 'w') as f:
+                count = bulk.export_ndjson(f, chunk_size=chunk_size)
+        sys.stderr.write('{} objects exported\n'.format(count))
+
+manager.add_command("export", Export())
+
+
+class Import(Command):
+    """Imports users, messages and archived messages from NDJSON."""
+    option_list = (
+        Option('-i', '--input', dest='input', default='-',
+               help='input file (default: stdin)'),
+        Option('-b', '--batch-size', dest='batch_size', type=int,
+               default=1000, help='number of rows inserted at a time'),
+        Option('-p', '--processes', dest='processes', type=int, default=None,
+               help='number of processes that render messages without HTML '
+               '(default: number of CPUs)'),
+    )
+
+    def run(self, input, batch_size, processes):
+        from flack import bulk
+        if input == '-':
+            counts = bulk.import_ndjson(sys.stdin, batch_size=batch_size,
+                                        processes=processes)
+        else:
+            with open(input) as f:
+                counts = bulk.import_ndjson(f, batch_size=batch_size,
+                                            processes=processes)
+        sys.stderr.write('{user} users, {message} messages and '
+                         '{archived_message} archived messages '
+                         'imported\n'.format(**counts))
+
+manager.add_command("import", Import())
+
+
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=1000, help='number of messages processed at a time')
+@manager.option('-p', '--processes', dest='processes', type=int,
+                default=None, help='number of rendering processes '
+                '(default: number of CPUs)')
+@manager.option('--checkpoint', dest='checkpoint', default=None,
+                help='file where progress is saved, to resume an '
+                'interrupted run')
+def rerender(chunk_size, processes, checkpoint):
+    """Renders the HTML of all the stored messages again."""
+    from flack import bulk
+    print('{} messages updated'.format(bulk.rerender_messages(
+        chunk_size=chunk_size, processes=processes, checkpoint=checkpoint)))
+
+
 @manager.command
 def createdb(drop_first=False):
     """Creates the database."""
@@ -99,6 +167,52 @@ def test():
     sys.exit(tests)
 
 
+@manager.command
+def archive():
+    """Moves old messages to the archive table."""
+    from flack import retention
+    print('{} messages archived'.format(retention.archive_messages()))
+
+
+@manager.command
+def reindex():
+    """Creates the message search index and indexes all the messages."""
+    from flack import search
+    with db.engine.begin() as connection:
+        search.get_backend().rebuild(connection)
+
+
+@manager.option('-u', '--users', dest='users', type=int, default=10,
+                help='number of simulated users')
+@manager.option('-m', '--messages', dest='messages', type=int, default=10,
+                help='number of messages posted by each user')
+@manager.option('-p', '--poll-every', dest='poll_every', type=int, default=5,
+                help='poll the user and message lists every N messages')
+@manager.option('--yes', dest='yes', action='store_true', default=False,
+                help='allow the benchmark to delete all the data in a '
+                'database that is not a benchmark SQLite database')
+def bench(users, messages, poll_every, yes):
+    """Runs a load generation benchmark."""
+    from flask import current_app
+    from flack import bench
+    app = current_app._get_current_object()
+    if not yes and bench.unsafe_databases(app):
+        sys.exit('The benchmark deletes all the data in {}. Use a SQLite '
+                 'database whose name starts with "bench", or add --yes to '
+                 'confirm.'.format(', '.join(bench.unsafe_databases(app))))
+    bench.run(app, num_users=users, num_messages=messages,
+              poll_every=poll_every, force=True)
+
+
+@manager.option('-n', '--runs', dest='runs', type=int, default=5,
+                help='number of times each process is started')
+def startup(runs):
+    """Measures startup time and memory of web and worker processes."""
+    from flack import bench
+    bench.startup(os.environ.get('FLACK_CONFIG', 'development'),
+                  num_runs=runs)
+
+
 @manager.command
 def lint():
     """Runs code linter."""
@@ -114,4 +228,8 @@ if __name__ == '__main__':
         # small hack, to ensure that Flask-Script uses the testing
         # configuration if we are going to run the tests
         os.environ['FLACK_CONFIG'] = 'testing'
+    elif sys.argv[1] == 'bench':
+        # same for the benchmark, which runs Celery tasks eagerly and does
+        # not need Redis
+        os.environ['FLACK_CONFIG'] = 'benchmark'
     manager.run()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# This script measures the size and CPU cost of compressing the response of
+# the /api/messages endpoint, using a list of messages similar to those sent
+# by real users. Usage is as follows:
+#     ./bench_compression.py [number of messages]
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['FLACK_CONFIG'] = 'testing'
+
+from flack import create_app, db
+from flack.compress import brotli
+from flack.models import User, Message
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+repeat = 5
+words = ['hello', 'world', 'flask', 'python', 'scale', 'chat', 'message',
+         'server', 'client', 'socket', 'database', 'celery', 'redis']
+
+app = create_app('testing')
+with app.app_context():
+    db.create_all()
+    users = [User(nickname='user' + str(i), password='x') for i in range(20)]
+    db.session.add_all(users)
+    random.seed(0)
+    for i in range(count):
+        source = ' '.join(random.choice(words)
+                          for j in range(random.randint(3, 25)))
+        if i % 3 == 0:
+            source += ' *' + random.choice(words) + '*'
+        if i % 10 == 0:
+            source += ' http://example.com/' + random.choice(words)
+        db.session.add(Message(user=random.choice(users), source=source))
+    db.session.commit()
+
+    data = app.test_client().get('/api/messages').get_data()
+
+print('{} messages, {} bytes uncompressed'.format(count, len(data)))
+print('{:<12}{:>12}{:>10}{:>14}'.format('encoding', 'bytes', 'ratio',
+                                        'CPU ms/resp'))
+
+
+def bench(name, compress):
+    start = time.process_time()
+    for i in range(repeat):
+        compressed = compress(data)
+    elapsed = (time.process_time() - start) / repeat
+    print('{:<12}{:>12}{:>10.2f}{:>14.2f}'.format(
+        name, len(compressed), len(data) / len(compressed), elapsed * 1000))
+
+
+for level in [1, 6, 9]:
+    bench('gzip-' + str(level),
+          lambda d: zlib.compress(d, level))
+if brotli is not None:
+    for quality in [1, 4, 6, 11]:
+        bench('br-' + str(quality),
+              lambda d: brotli.compress(d, quality=quality))
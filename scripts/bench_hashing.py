@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# This script measures how a burst of password checks, such as the one caused
+# by many clients requesting tokens at once, affects the latency of the other
+# greenlets in an eventlet server. A heartbeat greenlet that wakes up every
+# 10ms records how late it is, while the logins run with password hashing
+# done in the hub thread and offloaded to the thread pool. Usage is as
+# follows:
+#     ./bench_hashing.py [number of logins]
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug import security
+
+from flack import hashing
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+password_hash = security.generate_password_hash('bar')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def heartbeat(delays, done):
+    while not done:
+        start = time.time()
+        eventlet.sleep(0.01)
+        delays.append(time.time() - start - 0.01)
+
+
+print('{} logins'.format(count))
+print('{:<10}{:>12}{:>14}{:>14}{:>14}'.format(
+    'hashing', 'logins/s', 'hb p50 ms', 'hb p99 ms', 'hb max ms'))
+for name, check in [('inline', security.check_password_hash),
+                    ('offloaded', hashing.check_password_hash)]:
+    delays = []
+    done = []
+    hb = eventlet.spawn(heartbeat, delays, done)
+    eventlet.sleep(0.05)
+    start = time.time()
+    pool = eventlet.GreenPool(count)
+    for i in range(count):
+        pool.spawn(check, password_hash, 'bar')
+    pool.waitall()
+    elapsed = time.time() - start
+    done.append(True)
+    hb.wait()
+    print('{:<10}{:>12.1f}{:>14.2f}{:>14.2f}{:>14.2f}'.format(
+        name, count / elapsed, percentile(delays, 50) * 1000,
+        percentile(delays, 99) * 1000, max(delays) * 1000))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# This script compares the size on the wire and the CPU time needed to encode
+# updated_model Socket.IO events as JSON and as msgpack, for typical users and
+# messages. The sizes are those of the complete Socket.IO packets, including
+# the binary attachment placeholder of the msgpack events. Usage is as
+# follows:
+#     ./bench_packing.py [number of events]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['FLACK_CONFIG'] = 'testing'
+
+from socketio import packet
+
+from flack import create_app, db, packing
+from flack.models import User, Message
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+if packing.msgpack is None:
+    sys.exit('The msgpack package is not installed.')
+
+sources = [
+    'hi!',
+    'is anyone around to look at the *deploy* later today?',
+    'see https://github.com/miguelgrinberg/flack for the code, and let me '
+    'know what you think about the `Batcher` class in **batch.py**',
+]
+
+app = create_app('testing')
+with app.test_request_context():
+    db.create_all()
+    user = User(nickname='susan', password='bar')
+    db.session.add(user)
+    db.session.commit()
+    models = [user]
+    for source in sources:
+        msg = Message.create({'source': source}, user=user,
+                             expand_links=False)
+        db.session.add(msg)
+        models.append(msg)
+    db.session.commit()
+    for model in models:
+        model.to_dict()  # load the expired attributes
+    trace_id = '5c8f3e1a9b2d4f60'
+
+    def encode_json(model):
+        data = {'class': model.__class__.__name__, 'model': model.to_dict(),
+                'meta': {'trace_id': trace_id}}
+        return packet.Packet(packet.EVENT,
+                             data=['updated_model', data]).encode()
+
+    def encode_msgpack(model):
+        data = packing.pack_model(model, trace_id)
+        return packet.Packet(packet.EVENT,
+                             data=['updated_model', data]).encode()
+
+    def size(encoded):
+        if isinstance(encoded, list):
+            return sum(len(part) for part in encoded)
+        return len(encoded.encode('utf-8'))
+
+    print('{} events per model'.format(count))
+    print('{:<24}{:>10}{:>12}{:>10}{:>12}'.format(
+        'model', 'json B', 'json us', 'msgpack B', 'msgpack us'))
+    for model in models:
+        if isinstance(model, User):
+            name = 'User'
+        else:
+            name = 'Message ({} chars)'.format(len(model.source))
+        results = []
+        for f in [encode_json, encode_msgpack]:
+            start = time.process_time()
+            for i in range(count):
+                encoded = f(model)
+            elapsed = time.process_time() - start
+            results += [size(encoded), elapsed * 1000000 / count]
+        print('{:<24}{:>10}{:>12.1f}{:>10}{:>12.1f}'.format(name, *results))
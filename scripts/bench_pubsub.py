@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# This script measures the latency of the Socket.IO message queue, from the
+# time a message is published until it is received by the listener of the
+# server. The local Unix socket queue is always measured, and a Redis queue
+# is also measured when its URL is given. Usage is as follows:
+#     ./bench_pubsub.py [number of messages] [redis URL]
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import socketio
+
+from flack.pubsub import UnixSocketManager
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+path = tempfile.mkdtemp()
+managers = [('unix', lambda write_only: UnixSocketManager(
+    'unix://' + path, write_only=write_only))]
+if len(sys.argv) > 2:
+    managers.append(('redis', lambda write_only: socketio.RedisManager(
+        sys.argv[2], write_only=write_only)))
+
+print('{} messages'.format(count))
+print('{:<8}{:>12}{:>12}{:>12}'.format('queue', 'mean us', 'p99 us',
+                                       'max us'))
+for name, manager in managers:
+    listener = manager(False)
+    emitter = manager(True)
+    latencies = []
+    ready = threading.Event()
+    done = threading.Event()
+
+    def listen():
+        for message in listener._listen():
+            if not isinstance(message, bytes):
+                # the redis manager also yields subscription notices
+                ready.set()
+                continue
+            latencies.append(time.time() - pickle.loads(message)['sent_at'])
+            if len(latencies) == count:
+                done.set()
+
+    thread = threading.Thread(target=listen)
+    thread.daemon = True
+    thread.start()
+    if name == 'unix':
+        while listener.address is None or \
+                not os.path.exists(listener.address):
+            time.sleep(0.01)
+        ready.set()
+    ready.wait()
+
+    data = {'method': 'emit', 'event': 'updated_model',
+            'data': {'class': 'Message', 'model': {'source': 'x' * 200}},
+            'namespace': '/', 'room': None}
+    for i in range(count):
+        data['sent_at'] = time.time()
+        emitter._publish(data)
+        # wait for each message, so that latency is not queueing time
+        while len(latencies) <= i and not done.is_set():
+            time.sleep(0)
+    done.wait()
+    latencies.sort()
+    print('{:<8}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+        name, sum(latencies) / count * 1e6,
+        latencies[int(count * 0.99)] * 1e6, latencies[-1] * 1e6))
+shutil.rmtree(path, ignore_errors=True)
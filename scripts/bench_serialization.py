@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# This script compares the CPU time and peak memory needed to serialize the
+# messages table through ORM model instances against the lightweight Core
+# query path used by the list endpoints. Usage is as follows:
+#     ./bench_serialization.py [number of rows]
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['FLACK_CONFIG'] = 'testing'
+
+from flack import create_app, db
+from flack.models import User, Message
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+app = create_app('testing')
+with app.test_request_context():
+    db.create_all()
+    user = User(nickname='foo', password='bar')
+    db.session.add(user)
+    db.session.commit()
+    db.session.execute(Message.__table__.insert(), [
+        {'source': 'message *' + str(i) + '*',
+         'html': 'message <em>' + str(i) + '</em>',
+         'created_at': i, 'updated_at': i, 'user_id': user.id}
+        for i in range(count)])
+    db.session.commit()
+    db.session.remove()
+
+    def orm():
+        return [msg.to_dict() for msg in Message.query.order_by(
+            Message.updated_at).all()]
+
+    def core():
+        return [Message.row_to_dict(row) for row in db.session.execute(
+            Message.select().order_by(Message.updated_at))]
+
+    print('{} rows'.format(count))
+    print('{:<8}{:>16}{:>16}'.format('path', 'CPU ms/10k', 'peak KB/10k'))
+    for name, f in [('orm', orm), ('core', core)]:
+        tracemalloc.start()
+        start = time.process_time()
+        rv = f()
+        elapsed = time.process_time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(rv) == count
+        del rv
+        db.session.remove()
+        print('{:<8}{:>16.1f}{:>16.1f}'.format(
+            name, elapsed * 1000 * 10000 / count,
+            peak / 1024.0 * 10000 / count))
@@ -1,14 +1,56 @@
+import asyncio
 import base64
+from contextlib import contextmanager
+import gc
+import hashlib
+import io
 import json
+import os
+import pickle
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 import mock
 
 import requests
-
-from flack import create_app, db, socketio
-from flack.models import User
-from flack.tasks import async
+from flask import Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, ResultProxy
+
+from config import config
+from flack import create_app, db, socketio, sqlite, hashing, ratelimit, \
+    preload, retention, search, bulk, packing, aio, pubsub, presence, bench, \
+    compress
+from flack.models import User, Message, ArchivedMessage
+from flack.batch import Batcher
+from flack.events import create_messages, push_model, send_messages
+from flack.tasks import async_task, get_executor
+from flack.executor import Executor, QueueFull
+
+# Maximum number of SQL statements that each operation is allowed to issue.
+# Going over budget usually means that an N+1 query or an unnecessary commit
+# has been introduced.
+QUERY_BUDGETS = {
+    'POST /api/users': 3,
+    'POST /api/tokens': 5,
+    'DELETE /api/tokens': 3,
+    'GET /api/users': 2,
+    'GET /api/users/<id>': 2,
+    'POST /api/messages': 6,
+    'GET /api/messages': 2,
+    'GET /api/messages/<id>': 2,
+    'ping_user': 2,
+    'post_message': 5,
+    'post_messages (10 messages)': 13,
+    'POST /api/messages/batch (10 messages)': 15,
+}
 
 
 class FlackTests(unittest.TestCase):
@@ -17,7 +59,7 @@ class FlackTests(unittest.TestCase):
 
         # add an additional route used only in tests
         @self.app.route('/foo')
-        @async
+        @async_task
         def foo():
             1 / 0
 
@@ -46,10 +88,12 @@ class FlackTests(unittest.TestCase):
     def get(self, url, basic_auth=None, token_auth=None):
         rv = self.client.get(url,
                              headers=self.get_headers(basic_auth, token_auth))
+        # read the body before cleaning up the database session, since
+        # streamed responses are generated as they are read
+        body = rv.get_data(as_text=True)
         # clean up the database session, since this only occurs when the app
         # context is popped.
         db.session.remove()
-        body = rv.get_data(as_text=True)
         if body is not None and body != '':
             try:
                 body = json.loads(body)
@@ -61,10 +105,12 @@ class FlackTests(unittest.TestCase):
         d = data if data is None else json.dumps(data)
         rv = self.client.post(url, data=d,
                               headers=self.get_headers(basic_auth, token_auth))
+        # read the body before cleaning up the database session, since
+        # streamed responses are generated as they are read
+        body = rv.get_data(as_text=True)
         # clean up the database session, since this only occurs when the app
         # context is popped.
         db.session.remove()
-        body = rv.get_data(as_text=True)
         if body is not None and body != '':
             try:
                 body = json.loads(body)
@@ -76,10 +122,12 @@ class FlackTests(unittest.TestCase):
         d = data if data is None else json.dumps(data)
         rv = self.client.put(url, data=d,
                              headers=self.get_headers(basic_auth, token_auth))
+        # read the body before cleaning up the database session, since
+        # streamed responses are generated as they are read
+        body = rv.get_data(as_text=True)
         # clean up the database session, since this only occurs when the app
         # context is popped.
         db.session.remove()
-        body = rv.get_data(as_text=True)
         if body is not None and body != '':
             try:
                 body = json.loads(body)
@@ -90,10 +138,12 @@ class FlackTests(unittest.TestCase):
     def delete(self, url, basic_auth=None, token_auth=None):
         rv = self.client.delete(url, headers=self.get_headers(basic_auth,
                                                               token_auth))
+        # read the body before cleaning up the database session, since
+        # streamed responses are generated as they are read
+        body = rv.get_data(as_text=True)
         # clean up the database session, since this only occurs when the app
         # context is popped.
         db.session.remove()
-        body = rv.get_data(as_text=True)
         if body is not None and body != '':
             try:
                 body = json.loads(body)
@@ -101,6 +151,28 @@ class FlackTests(unittest.TestCase):
                 pass
         return body, rv.status_code, rv.headers
 
+    @contextmanager
+    def query_budget(self, name):
+        """Fail the test if the enclosed code issues more SQL statements
+        than the budget for the given operation allows.
+        """
+        statements = []
+
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        try:
+            yield
+        finally:
+            event.remove(Engine, 'after_cursor_execute', after_cursor_execute)
+        budget = QUERY_BUDGETS[name]
+        if len(statements) > budget:
+            self.fail('{} issued {} SQL statements, over its budget of {}:\n'
+                      '{}'.format(name, len(statements), budget,
+                                  '\n'.join(statements)))
+
     def test_user(self):
         # get users without auth
         r, s, h = self.get('/api/users')
@@ -344,7 +416,7 @@ class FlackTests(unittest.TestCase):
             yield rv
             yield requests.exceptions.ConnectionError()
 
-        with mock.patch('flack.models.requests.get', side_effect=responses()):
+        with mock.patch('requests.get', side_effect=responses()):
             r, s, h = self.post(
                 '/api/messages',
                 data={'source': 'hello http://foo.com!'},
@@ -392,6 +464,1092 @@ class FlackTests(unittest.TestCase):
                 'hello <a href="http://foo.com" rel="nofollow">'
                 'foo.com</a>!')
 
+    def test_streaming(self):
+        # create a user and enough messages to span several chunks
+        user = User(nickname='foo', password='bar')
+        db.session.add(user)
+        for i in range(250):
+            db.session.add(Message(user=user, source='msg ' + str(i)))
+        db.session.commit()
+        user_id = user.id
+
+        # get list of messages, which are fetched in chunks
+        fetchmany = ResultProxy.fetchmany
+        with mock.patch.object(ResultProxy, 'fetchmany', autospec=True,
+                               side_effect=fetchmany) as m, \
+                mock.patch.object(ResultProxy, 'fetchall') as fetchall:
+            r, s, h = self.get('/api/messages')
+        self.assertEqual(s, 200)
+        self.assertNotIn('Content-Length', h)
+        self.assertEqual(len(r['messages']), 250)
+        self.assertEqual(fetchall.call_count, 0)
+        self.assertEqual([c[0][1] for c in m.call_args_list], [100] * 4)
+        self.assertEqual(r['messages'][0]['html'], 'msg 0')
+        self.assertEqual(r['messages'][0]['user_id'], user_id)
+
+        # get list of users
+        r, s, h = self.get('/api/users')
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['users']), 1)
+        self.assertEqual(r['users'][0]['nickname'], 'foo')
+
+    def test_compression(self):
+        user = User(nickname='foo', password='bar')
+        db.session.add(user)
+        for i in range(50):
+            db.session.add(Message(user=user, source='msg ' + str(i)))
+        db.session.commit()
+
+        # streamed list response is compressed
+        rv = self.client.get('/api/messages',
+                             headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        r = json.loads(zlib.decompress(rv.get_data(), 16 + zlib.MAX_WBITS)
+                       .decode('utf-8'))
+        self.assertEqual(len(r['messages']), 50)
+
+        # small responses are sent uncompressed
+        rv = self.client.get('/api/users/1',
+                             headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEqual(json.loads(rv.get_data(as_text=True))['nickname'],
+                         'foo')
+
+        # clients that do not accept gzip get uncompressed responses
+        rv = self.client.get('/api/messages',
+                             headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+        r = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(len(r['messages']), 50)
+
+        # servers read streamed responses after the request context is gone
+        self.ctx.pop()
+        try:
+            with self.app.test_request_context(
+                    headers={'Accept-Encoding': 'gzip'}):
+                rv = compress.compress_response(Response(
+                    iter(['[', '1' * 1000, ']']), mimetype='application/json'))
+            data = b''.join(rv.response)
+        finally:
+            self.ctx.push()
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                         b'[' + b'1' * 1000 + b']')
+
+    def test_stats(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.get('/api/users')
+        self.assertEqual(s, 200)
+        client = socketio.test_client(self.app)
+        client.emit('ping_user', token)
+
+        r, s, h = self.get('/stats')
+        self.assertEqual(s, 200)
+        self.assertIn('requests_per_second', r)
+        self.assertGreaterEqual(r['endpoints']['api.new_user']['count'], 1)
+        self.assertGreaterEqual(r['endpoints']['api.new_user']['sql_count'],
+                                2)
+        self.assertGreaterEqual(r['endpoints']['api.get_users']['sql_count'],
+                                1)
+        self.assertGreaterEqual(r['events']['ping_user']['count'], 1)
+        self.assertGreaterEqual(r['events']['ping_user']['sql_count'], 1)
+
+        rv = self.client.get('/stats/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        body = rv.get_data(as_text=True)
+        self.assertIn('# TYPE flack_sql_statements_total counter', body)
+        self.assertIn('flack_requests_total{kind="http",name="api.new_user"}',
+                      body)
+
+    def test_tracing(self):
+        from flack.wsgi_aux import app as aux_app
+
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        client = socketio.test_client(self.app)
+
+        # trace ids sent by clients are only used if they are valid
+        trace_id = '5c8f3e1a-9b2d-4f60-8e3b-2a1d6c9f7e40'
+        rv = self.client.get('/api/users/1',
+                             headers={'X-Trace-Id': trace_id})
+        self.assertEqual(rv.headers['X-Trace-Id'], trace_id)
+        for trace_id in ['a' * 65, 'foo bar', '{"x": 1}']:
+            rv = self.client.get('/api/users/1',
+                                 headers={'X-Trace-Id': trace_id})
+            self.assertNotEqual(rv.headers['X-Trace-Id'], trace_id)
+            self.assertEqual(len(rv.headers['X-Trace-Id']), 32)
+        db.session.remove()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        sink = {'TRACE_SINK': 'file:' + path}
+        try:
+            with mock.patch.dict(self.app.config, sink), \
+                    mock.patch.dict(aux_app.config, sink):
+                # post a message through the REST API
+                r, s, h = self.post('/api/messages', data={'source': 'foo'},
+                                    token_auth=token)
+                self.assertEqual(s, 201)
+                rest_trace_id = h['X-Trace-Id']
+
+                # post a message through Socket.IO
+                client.get_received()
+                client.emit('post_message', {'source': 'bar'}, token)
+                recvd = client.get_received()
+                socketio_trace_id = recvd[0]['args'][0]['meta']['trace_id']
+
+            with open(path) as f:
+                spans = [json.loads(line) for line in f.readlines()]
+        finally:
+            os.remove(path)
+
+        rest_spans = [span['span'] for span in spans
+                      if span['trace_id'] == rest_trace_id]
+        self.assertIn('http api.new_message', rest_spans)
+        self.assertIn('enqueue run_flask_request', rest_spans)
+        self.assertIn('task run_flask_request', rest_spans)
+        socketio_spans = [span['span'] for span in spans
+                          if span['trace_id'] == socketio_trace_id]
+        self.assertIn('event post_message', socketio_spans)
+        self.assertIn('enqueue post_messages', socketio_spans)
+        self.assertIn('task post_messages', socketio_spans)
+        self.assertIn('push_model', socketio_spans)
+        for span in spans:
+            self.assertGreaterEqual(span['duration'], 0)
+
+    def test_bench(self):
+        # databases that are not scratch databases are not touched
+        for url in ['postgresql://user@db/flack', 'sqlite:////tmp/db.sqlite']:
+            with mock.patch.dict(self.app.config,
+                                 {'SQLALCHEMY_DATABASE_URI': url}):
+                self.assertRaises(RuntimeError, bench.run, self.app)
+        self.assertTrue(bench.is_scratch_database('sqlite://'))
+
+        # the threads of the simulated users need a database file, as they
+        # would each get their own in-memory database
+        path = tempfile.mkdtemp()
+
+        class BenchConfig(config['testing']):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                path, 'bench.sqlite')
+
+        with mock.patch.dict(config, {'bench': BenchConfig}):
+            app = create_app('bench')
+        try:
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                results = bench.run(app, num_users=3, num_messages=4,
+                                    poll_every=2)
+            self.assertIn('12 messages', out.getvalue())
+            self.assertEqual(len(results.latencies), 6)
+            self.assertEqual(len(results.operations['post_rest'][0]), 6)
+            self.assertEqual(len(results.operations['post_socketio'][0]), 6)
+            self.assertEqual(len(results.operations['poll_messages'][0]), 6)
+            self.assertEqual(len(results.operations['heartbeat'][0]), 15)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def test_query_budgets(self):
+        # freeze the timestamps given to User.ping(), so that the number of
+        # statements does not depend on the last seen time of the user
+        # changing during the test
+        patcher = mock.patch('flack.models.timestamp',
+                             return_value=int(time.time()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with self.query_budget('POST /api/users'):
+            r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                    'password': 'bar'})
+            self.assertEqual(s, 201)
+        r, s, h = self.post('/api/users', data={'nickname': 'bar',
+                                                'password': 'baz'})
+        self.assertEqual(s, 201)
+        with self.query_budget('POST /api/tokens'):
+            r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+            self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.post('/api/tokens', basic_auth='bar:baz')
+        self.assertEqual(s, 200)
+        token2 = r['token']
+
+        # post messages from both users, so that lists have several authors
+        for i in range(10):
+            with self.query_budget('POST /api/messages'):
+                r, s, h = self.post('/api/messages',
+                                    data={'source': 'hello ' + str(i)},
+                                    token_auth=token if i % 2 else token2)
+                self.assertEqual(s, 201)
+        url = h['Location']
+
+        with self.query_budget('GET /api/users'):
+            r, s, h = self.get('/api/users', token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(len(r['users']), 2)
+        with self.query_budget('GET /api/users/<id>'):
+            r, s, h = self.get('/api/users/1', token_auth=token)
+            self.assertEqual(s, 200)
+        with self.query_budget('GET /api/messages'):
+            r, s, h = self.get('/api/messages', token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(len(r['messages']), 10)
+        with self.query_budget('GET /api/messages/<id>'):
+            r, s, h = self.get(url, token_auth=token)
+            self.assertEqual(s, 200)
+
+        client = socketio.test_client(self.app)
+        with self.query_budget('ping_user'):
+            client.emit('ping_user', token)
+            db.session.remove()
+        with self.query_budget('post_message'):
+            client.emit('post_message', {'source': 'hello'}, token)
+            db.session.remove()
+        self.assertEqual(len(client.get_received()), 1)
+
+        with self.query_budget('DELETE /api/tokens'):
+            r, s, h = self.delete('/api/tokens', token_auth=token)
+            self.assertEqual(s, 204)
+
+    def test_sqlite_writer(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        class SQLiteConfig(config['testing']):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            SQLITE_PRAGMAS = config['production'].SQLITE_PRAGMAS
+            SQLITE_WRITER = True
+            SQLITE_WRITER_MAX_DELAY = 0.05
+
+        with mock.patch.dict(config, {'sqlite': SQLiteConfig}):
+            app = create_app('sqlite')
+        try:
+            with app.app_context():
+                db.create_all()
+                self.assertEqual(
+                    db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+                users = [User(nickname='user' + str(i), password_hash='x')
+                         for i in range(20)]
+                db.session.add_all(users)
+                db.session.commit()
+                ids = [user.id for user in users]
+                db.session.remove()
+
+                # ping all the users concurrently
+                def ping(id):
+                    with app.app_context():
+                        user = User.query.get(id)
+                        user.ping()
+                        sqlite.save(user, 'last_seen_at', 'online')
+                        db.session.commit()
+                        db.session.remove()
+
+                threads = [threading.Thread(target=ping, args=(id,))
+                           for id in ids]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                # the updates were grouped into fewer transactions
+                self.assertLess(sqlite.get_writer().commits, len(ids))
+                self.assertEqual(User.query.filter_by(online=True).count(),
+                                 len(ids))
+
+                # users whose attributes did not change are not written
+                user = User.query.get(ids[0])
+                updated_at = user.updated_at
+                commits = sqlite.get_writer().commits
+                user.last_seen_at = user.last_seen_at
+                user.online = True
+                sqlite.save(user, 'last_seen_at', 'online')
+                self.assertEqual(sqlite.get_writer().commits, commits)
+                self.assertEqual(user.updated_at, updated_at)
+                user.last_seen_at += 1
+                sqlite.save(user, 'last_seen_at', 'online')
+                self.assertEqual(sqlite.get_writer().commits, commits + 1)
+                db.session.remove()
+
+                # find_offline_users also goes through the writer
+                db.session.execute(User.__table__.update().values(
+                    last_seen_at=0))
+                db.session.commit()
+                self.assertEqual(len(User.find_offline_users()), len(ids))
+                self.assertEqual(User.query.filter_by(online=True).count(),
+                                 0)
+                db.session.remove()
+        finally:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_replica(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        class ReplicaConfig(config['testing']):
+            SQLALCHEMY_REPLICA_URI = 'sqlite:///' + path
+            REPLICA_CHECK_INTERVAL = 0
+
+        with mock.patch.dict(config, {'replica': ReplicaConfig}):
+            app = create_app('replica')
+        ctx = app.app_context()
+        ctx.push()
+        client = self.client
+        self.client = app.test_client()
+        try:
+            db.create_all()
+            replica = db.get_engine(app, 'replica')
+            db.Model.metadata.create_all(bind=replica)
+
+            # new users are written to the primary only, so until they are
+            # replicated the replica lags behind and is not used
+            r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                    'password': 'bar'})
+            self.assertEqual(s, 201)
+            self.assertTrue(app.extensions['replica_writes'].wrote_recently(
+                r['id'], 5))
+            r, s, h = self.get('/api/users')
+            self.assertEqual(s, 200)
+            self.assertEqual(len(r['users']), 1)
+
+            # once replicated, the user can be read from the replica
+            user = db.session.execute(User.__table__.select()).first()
+            db.session.execute(User.__table__.insert(), dict(user),
+                               bind=replica)
+            db.session.commit()
+            r, s, h = self.get('/api/users')
+            self.assertEqual(len(r['users']), 1)
+            r, s, h = self.get('/api/users/' + str(user.id))
+            self.assertEqual(s, 200)
+            self.assertEqual(r['nickname'], 'foo')
+
+            # a replica that lags too much is not used
+            now = int(time.time())
+            db.session.execute(Message.__table__.insert(), {
+                'source': 'foo', 'html': 'foo', 'user_id': user.id,
+                'created_at': now, 'updated_at': now})
+            db.session.commit()
+            r, s, h = self.get('/api/messages')
+            self.assertEqual(len(r['messages']), 1)
+
+            # a replica that is within the staleness window is used
+            for source in ['foo', 'replica only']:
+                db.session.execute(Message.__table__.insert(), {
+                    'source': source, 'html': source, 'user_id': user.id,
+                    'created_at': now, 'updated_at': now}, bind=replica)
+            db.session.commit()
+            r, s, h = self.get('/api/messages')
+            self.assertEqual(len(r['messages']), 2)
+
+            # users that just wrote something read from the primary
+            r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+            self.assertEqual(s, 200)
+            r, s, h = self.get('/api/messages', token_auth=r['token'])
+            self.assertEqual(len(r['messages']), 1)
+            self.assertTrue(app.extensions['replica_writes'].wrote_recently(
+                user.id, 5))
+
+            # lag in the users table also makes the replica unusable
+            db.session.execute(User.__table__.update().values(
+                updated_at=now + 60))
+            db.session.commit()
+            r, s, h = self.get('/api/messages')
+            self.assertEqual(len(r['messages']), 1)
+
+            db.drop_all()
+            db.Model.metadata.drop_all(bind=replica)
+        finally:
+            self.client = client
+            ctx.pop()
+            os.remove(path)
+
+    def test_batching(self):
+        # batches are bounded in size
+        batches = []
+        batcher = Batcher(batches.append, max_size=4, max_delay=1)
+        for i in range(10):
+            batcher.add(i)
+        while sum(len(batch) for batch in batches) < 10:
+            time.sleep(0.01)
+        self.assertEqual(batches[0], [0, 1, 2, 3])
+        self.assertEqual(batches[1], [4, 5, 6, 7])
+
+        # and in time
+        batches = []
+        batcher = Batcher(batches.append, max_size=100, max_delay=0.01)
+        batcher.add('foo')
+        start = time.time()
+        while not batches:
+            time.sleep(0.001)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(batches, [['foo']])
+
+        # items waiting for their batch are flushed on shutdown
+        batches = []
+        batcher = Batcher(batches.append, max_size=100, max_delay=60)
+        batcher.add('foo')
+        batcher.add('bar')
+        start = time.time()
+        batcher.shutdown(5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(batches, [['foo', 'bar']])
+        self.assertFalse(batcher.thread.is_alive())
+
+        # a batch of messages is written with a single commit
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/users', data={'nickname': 'bar',
+                                                'password': 'baz'})
+        self.assertEqual(s, 201)
+        client = socketio.test_client(self.app)
+        client.get_received()
+        batch = [(1 + i % 2, {'source': 'msg ' + str(i)}, None)
+                 for i in range(10)]
+        batch.append((1, {'foo': 'invalid'}, None))
+        batch.append((3, {'source': 'unknown user'}, None))
+        commits = []
+
+        def on_commit(conn):
+            commits.append(conn)
+
+        event.listen(Engine, 'commit', on_commit)
+        try:
+            with self.query_budget('post_messages (10 messages)'):
+                create_messages(batch)
+        finally:
+            event.remove(Engine, 'commit', on_commit)
+        self.assertEqual(len(commits), 1)
+        recvd = client.get_received()
+        self.assertEqual([pkt['args'][0]['model']['source'] for pkt in recvd],
+                         ['msg ' + str(i) for i in range(10)])
+        self.assertEqual(recvd[1]['args'][0]['model']['user_id'], 2)
+        self.assertEqual(Message.query.count(), 10)
+
+    def test_batch_messages(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+
+        # the batch must be a non-empty list within the size limit
+        r, s, h = self.post('/api/messages/batch', data={'source': 'foo'},
+                            token_auth=token)
+        self.assertEqual(s, 400)
+        r, s, h = self.post('/api/messages/batch', data=[], token_auth=token)
+        self.assertEqual(s, 400)
+        r, s, h = self.post('/api/messages/batch',
+                            data=[{'source': 'foo'}] * 101, token_auth=token)
+        self.assertEqual(s, 400)
+        r, s, h = self.post('/api/messages/batch', data=[{'source': 'foo'}])
+        self.assertEqual(s, 401)
+
+        # invalid items are reported without failing the others
+        data = [{'source': 'msg *' + str(i) + '*'} for i in range(10)]
+        data.insert(3, {'foo': 'bar'})
+        data.insert(5, {'source': None})
+        with self.query_budget('POST /api/messages/batch (10 messages)'):
+            r, s, h = self.post('/api/messages/batch', data=data,
+                                token_auth=token)
+        self.assertEqual(s, 200)
+        self.assertEqual([result['status'] for result in r['results']],
+                         [201] * 3 + [400, 201, 400] + [201] * 6)
+        msgs = [result['message'] for result in r['results']
+                if result['status'] == 201]
+        self.assertEqual([msg['source'] for msg in msgs],
+                         ['msg *' + str(i) + '*' for i in range(10)])
+        self.assertEqual(msgs[0]['html'], 'msg <em>0</em>')
+        self.assertEqual(len(set(msg['id'] for msg in msgs)), 10)
+        self.assertEqual(Message.query.count(), 10)
+
+    def test_hashing(self):
+        # passwords hash and verify as before
+        password_hash = hashing.generate_password_hash('bar')
+        self.assertTrue(hashing.check_password_hash(password_hash, 'bar'))
+        self.assertFalse(hashing.check_password_hash(password_hash, 'baz'))
+
+        # the number of concurrent hashes is capped
+        self.app.config['PASSWORD_HASH_CONCURRENCY'] = 2
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                running.append(True)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+        def run():
+            with self.app.app_context():
+                hashing.offload(work)
+
+        threads = [threading.Thread(target=run) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_rate_limits(self):
+        # token buckets allow bursts and then refill at the given rate
+        backend = ratelimit.MemoryBackend()
+        with mock.patch('flack.ratelimit.time.time', return_value=1000.0):
+            self.assertEqual(backend.consume('foo', 2, 3), 0)
+            self.assertEqual(backend.consume('foo', 2, 3), 0)
+            self.assertEqual(backend.consume('foo', 2, 3), 0)
+            self.assertEqual(backend.consume('foo', 2, 3), 0.5)
+            self.assertEqual(backend.consume('bar', 2, 3), 0)
+        with mock.patch('flack.ratelimit.time.time', return_value=1000.5):
+            self.assertEqual(backend.consume('foo', 2, 3), 0)
+            self.assertEqual(backend.consume('foo', 2, 3), 0.5)
+
+        # the least recently used bucket is dropped when none has refilled
+        backend = ratelimit.MemoryBackend(max_keys=2)
+        with mock.patch('flack.ratelimit.time.time', return_value=1000.0):
+            backend.consume('foo', 2, 3)
+            backend.consume('bar', 2, 3)
+            backend.consume('foo', 2, 3)
+            backend.consume('baz', 2, 3)
+        self.assertEqual(list(backend.buckets), ['foo', 'baz'])
+
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        self.app.config['RATELIMITS'] = {
+            'new_token': {'ip': (0.1, 2)},
+            'new_message': {'ip': (100, 100), 'token': (0.1, 1)},
+        }
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 429)
+        self.assertEqual(h['Retry-After'], '10')
+
+        # limits are applied per token
+        r, s, h = self.post('/api/messages', data={'source': 'foo'},
+                            token_auth=token)
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/messages', data={'source': 'foo'},
+                            token_auth=token)
+        self.assertEqual(s, 429)
+        r, s, h = self.post('/api/messages', data={'source': 'foo'},
+                            token_auth='bad-token')
+        self.assertEqual(s, 401)
+
+        # but only to tokens that were verified
+        buckets = list(ratelimit.get_backend().buckets)
+        self.assertIn('new_message:token:' + hashlib.sha1(
+            token.encode('utf-8')).hexdigest(), buckets)
+        self.assertEqual(len([key for key in buckets if ':token:' in key]),
+                         1)
+
+        # load is shed when the database is slow
+        with mock.patch('flack.stats.sql_latency', return_value=10):
+            r, s, h = self.post('/api/messages', data={'source': 'foo'},
+                                token_auth='bad-token')
+        self.assertEqual(s, 503)
+        self.assertEqual(Message.query.count(), 1)
+
+        # behind a trusted proxy, clients are told apart by the address in
+        # X-Forwarded-For
+        class ProxyConfig(config['testing']):
+            PROXY_FIX_X_FOR = 1
+            RATELIMITS = {'new_token': {'ip': (0.1, 1)}}
+
+        for config_name, statuses in [('testing', [401, 429, 429]),
+                                      ('proxy', [401, 429, 401])]:
+            with mock.patch.dict(config, {'proxy': ProxyConfig}):
+                app = create_app(config_name)
+            app.config['RATELIMITS'] = ProxyConfig.RATELIMITS
+            client = app.test_client()
+            self.assertEqual([client.post('/api/tokens', headers={
+                'X-Forwarded-For': address}).status_code
+                for address in ['1.2.3.4', '1.2.3.4', '5.6.7.8']], statuses)
+            if config_name == 'proxy':
+                self.assertEqual(
+                    sorted(app.extensions['ratelimit'].buckets),
+                    ['new_token:ip:1.2.3.4', 'new_token:ip:5.6.7.8'])
+
+    def test_lazy_imports(self):
+        # the rendering and scraping libraries are not loaded on startup
+        out = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys; from flack import create_app; '
+             'create_app("testing"); '
+             'print(" ".join(sorted(set(sys.modules) & {"markdown", '
+             '"bleach", "bs4", "html5lib"})))'],
+            cwd=os.path.join(os.path.dirname(__file__), '..'))
+        self.assertEqual(out.decode('utf-8').strip(), '')
+
+        # but they are loaded when a message is rendered
+        msg = Message(source='*foo*')
+        self.assertEqual(msg.html, '<em>foo</em>')
+
+    def test_preload(self):
+        # warming up compiles the templates and loads the renderers, without
+        # using the database
+        statements = []
+
+        def after_cursor_execute(*args):
+            statements.append(args[2])
+
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        try:
+            preload.warm_up(self.app)
+        finally:
+            event.remove(Engine, 'after_cursor_execute', after_cursor_execute)
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        self.assertEqual(statements, [])
+        self.assertIn('index.html',
+                      [key[1] for key in self.app.jinja_env.cache.keys()])
+        self.assertIn('markdown', sys.modules)
+
+        # after a fork the database pool and the rate limiter are replaced
+        with self.app.test_request_context():
+            ratelimit.get_backend()
+        pool = db.engine.pool
+        preload.post_fork(self.app)
+        self.assertIsNot(db.engine.pool, pool)
+        self.assertNotIn('ratelimit', self.app.extensions)
+
+        # the local task backend only works with a single worker process
+        self.app.config['TASK_BACKEND'] = 'local'
+        preload.post_fork(self.app, workers=1)
+        with self.assertRaises(RuntimeError):
+            preload.post_fork(self.app, workers=4)
+
+        # and the memory presence backend gets a warning
+        self.app.config['TASK_BACKEND'] = 'celery'
+        self.app.config['PRESENCE_BACKEND'] = 'memory'
+        with self.assertLogs('flack.preload', 'WARNING'):
+            preload.post_fork(self.app, workers=4)
+
+    def test_search(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.post('/api/messages/batch', data=[
+            {'source': 'the quick brown fox'},
+            {'source': 'the lazy dog'},
+            {'source': 'a fox, a fox and another fox'},
+            {'source': 'quick "fox" AND NOT'}], token_auth=token)
+        self.assertEqual(s, 200)
+        ids = [result['message']['id'] for result in r['results']]
+
+        # results are ranked, and special characters match literally
+        r, s, h = self.get('/api/messages/search?q=fox')
+        self.assertEqual(s, 200)
+        self.assertEqual([msg['id'] for msg in r['messages']][0], ids[2])
+        self.assertEqual(len(r['messages']), 3)
+        r, s, h = self.get('/api/messages/search?q=quick+fox')
+        self.assertEqual(sorted(msg['id'] for msg in r['messages']),
+                         [ids[0], ids[3]])
+        r, s, h = self.get('/api/messages/search?q="fox"+NOT')
+        self.assertEqual([msg['id'] for msg in r['messages']], [ids[3]])
+        r, s, h = self.get('/api/messages/search?q=')
+        self.assertEqual(s, 400)
+
+        # results are paged
+        r, s, h = self.get('/api/messages/search?q=fox&per_page=2')
+        self.assertEqual(len(r['messages']), 2)
+        r, s, h = self.get(r['_links']['next'])
+        self.assertEqual(len(r['messages']), 1)
+        self.assertNotIn('_links', r)
+
+        # the index follows edits
+        r, s, h = self.put('/api/messages/' + str(ids[1]),
+                           data={'source': 'the lazy fox'}, token_auth=token)
+        self.assertEqual(s, 204)
+        r, s, h = self.get('/api/messages/search?q=lazy+fox')
+        self.assertEqual([msg['id'] for msg in r['messages']], [ids[1]])
+        r, s, h = self.get('/api/messages/search?q=dog')
+        self.assertEqual(r['messages'], [])
+
+        # the LIKE backend returns the same matches, newest first
+        self.app.extensions['search'] = search.LikeSearchBackend()
+        r, s, h = self.get('/api/messages/search?q=quick+fox')
+        self.assertEqual([msg['id'] for msg in r['messages']],
+                         [ids[3], ids[0]])
+
+        # without FTS5 in SQLite the tables are still created, and searches
+        # fall back to LIKE
+        self.app.extensions['search'] = search.FTS5SearchBackend()
+        db.drop_all()
+        with mock.patch.object(search.FTS5SearchBackend, 'module',
+                               'no_such_module'):
+            db.create_all()
+        self.assertFalse(search.get_backend().has_index(
+            db.session.connection()))
+        db.session.add(Message(source='the quick fox',
+                               user=User(nickname='foo', password='bar')))
+        db.session.commit()
+        r, s, h = self.get('/api/messages/search?q=quick+fox')
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['messages']), 1)
+
+    def test_retention(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        now = int(time.time())
+        with mock.patch('flack.utils.time.time', return_value=now - 1000):
+            r, s, h = self.post('/api/messages/batch', data=[
+                {'source': 'old fox ' + str(i)} for i in range(6)],
+                token_auth=token)
+        self.assertEqual(s, 200)
+        old_ids = [result['message']['id'] for result in r['results']]
+        r, s, h = self.post('/api/messages/batch', data=[
+            {'source': 'new fox ' + str(i)} for i in range(2)],
+            token_auth=token)
+        self.assertEqual(s, 200)
+
+        # old messages are moved in bounded batches
+        self.assertEqual(retention.archive_messages(
+            max_age=100, batch_size=2, max_batches=2), 4)
+        self.assertEqual(retention.archive_messages(
+            max_age=100, batch_size=2, max_batches=2), 2)
+        self.assertEqual(retention.archive_messages(max_age=100), 0)
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(ArchivedMessage.query.count(), 6)
+
+        # archived messages can still be retrieved, but not searched
+        r, s, h = self.get('/api/messages/' + str(old_ids[0]))
+        self.assertEqual(s, 200)
+        self.assertEqual(r['source'], 'old fox 0')
+        r, s, h = self.get('/api/messages/search?q=fox')
+        self.assertEqual(sorted(msg['source'] for msg in r['messages']),
+                         ['new fox 0', 'new fox 1'])
+
+        # the newest message is kept, so that its id is not reused
+        db.session.execute(Message.__table__.update().values(updated_at=0))
+        db.session.commit()
+        self.assertEqual(retention.archive_messages(
+            max_age=100, max_batches=0), 0)
+        self.assertEqual(retention.archive_messages(max_age=100), 1)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_bulk(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.post('/api/messages/batch', data=[
+            {'source': 'message *' + str(i) + '*'} for i in range(5)],
+            token_auth=token)
+        self.assertEqual(s, 200)
+        db.session.execute(ArchivedMessage.__table__.insert().values(
+            id=100, created_at=1, updated_at=1, source='*archived*',
+            html='<em>archived</em>', user_id=1, archived_at=2))
+        db.session.commit()
+
+        # export all the objects, users first and archived messages last
+        f = io.StringIO()
+        self.assertEqual(bulk.export_ndjson(f, chunk_size=2), 7)
+        lines = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual([line['type'] for line in lines],
+                         ['user'] + ['message'] * 5 + ['archived_message'])
+        self.assertEqual(lines[6]['archived_at'], 2)
+        self.assertEqual(lines[2]['html'], 'message <em>1</em>')
+
+        # import them into an empty database, rendering the messages that
+        # come without HTML
+        del lines[3]['html']
+        lines[3]['source'] = 'edited *message*'
+        del lines[4]['html']
+        db.drop_all()
+        db.create_all()
+        f = io.StringIO(''.join(json.dumps(line) + '\n' for line in lines))
+        self.assertEqual(bulk.import_ndjson(f, batch_size=2, processes=2),
+                         {'user': 1, 'message': 5, 'archived_message': 1})
+        self.assertEqual(User.query.get(1).nickname, 'foo')
+        self.assertIsNone(User.query.get(1).token)
+        msgs = Message.query.order_by(Message.id).all()
+        self.assertEqual([msg.html for msg in msgs],
+                         ['message <em>0</em>', 'message <em>1</em>',
+                          'edited <em>message</em>', 'message <em>3</em>',
+                          'message <em>4</em>'])
+        r, s, h = self.get('/api/messages/search?q=edited')
+        self.assertEqual([msg['id'] for msg in r['messages']], [msgs[2].id])
+        archived = retention.get_archived_message(100)
+        self.assertEqual(archived.html, '<em>archived</em>')
+        r, s, h = self.get('/api/messages/search?q=archived')
+        self.assertEqual(r['messages'], [])
+
+        # the imported user can log in
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+
+    def test_rerender(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        r, s, h = self.post('/api/messages/batch', data=[
+            {'source': 'message *' + str(i) + '*'} for i in range(5)],
+            token_auth=r['token'])
+        self.assertEqual(s, 200)
+        ids = [msg.id for msg in Message.query.order_by(Message.id)]
+
+        # make the stored HTML stale, and give one message an expanded link
+        db.session.execute(Message.__table__.update().values(
+            html='stale', updated_at=1))
+        db.session.execute(Message.__table__.update().where(
+            Message.id == ids[1]).values(
+                html='stale<blockquote><p>link</p></blockquote>',
+                updated_at=1))
+        db.session.commit()
+
+        # resume after the second message
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(checkpoint, 'w') as f:
+                f.write(str(ids[1]))
+            self.assertEqual(bulk.rerender_messages(
+                chunk_size=2, processes=2, checkpoint=checkpoint), 3)
+            self.assertFalse(os.path.exists(checkpoint))
+            db.session.expire_all()
+            self.assertEqual([msg.html for msg in Message.query.order_by(
+                Message.id)], ['stale', 'stale<blockquote><p>link</p>'
+                               '</blockquote>', 'message <em>2</em>',
+                               'message <em>3</em>', 'message <em>4</em>'])
+
+            # the messages that changed have a new updated_at, so that
+            # clients that poll for changes get them
+            r, s, h = self.get('/api/messages?updated_since=2')
+            self.assertEqual(sorted(msg['id'] for msg in r['messages']),
+                             ids[2:])
+
+            # the next run with the same checkpoint starts over, renders the
+            # rest, and keeps the expanded link
+            self.assertEqual(bulk.rerender_messages(
+                chunk_size=2, checkpoint=checkpoint), 2)
+            self.assertFalse(os.path.exists(checkpoint))
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        db.session.expire_all()
+        msgs = Message.query.order_by(Message.id).all()
+        self.assertEqual(msgs[1].html, 'message <em>1</em><blockquote>'
+                         '<p>link</p></blockquote>')
+        self.assertTrue(all(msg.updated_at > 1 for msg in msgs))
+        self.assertEqual(bulk.rerender_messages(chunk_size=2), 0)
+
+    @unittest.skipIf(packing.msgpack is None, 'msgpack is not installed')
+    def test_packing(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        user = User.query.filter_by(nickname='foo').first()
+        msg = Message.create({'source': '*hello*'}, user=user,
+                             expand_links=False)
+        db.session.add(msg)
+        db.session.commit()
+
+        # the packed models decode to the JSON representation without links
+        for model in [user, msg]:
+            data = model.to_dict()
+            del data['_links']
+            self.assertEqual(packing.unpack_model(packing.pack_model(model)),
+                             {'class': model.__class__.__name__,
+                              'model': data})
+            self.assertLess(len(packing.pack_model(model, 'abc')),
+                            len(json.dumps(model.to_dict())))
+        self.assertEqual(packing.unpack_model(packing.pack_model(
+            msg, 'abc'))['meta'], {'trace_id': 'abc'})
+
+        # clients choose their encoding when they connect
+        with self.app.test_request_context('/socket.io/?encoding=msgpack'):
+            self.assertEqual(packing.client_room(), packing.MSGPACK_ROOM)
+        with self.app.test_request_context('/socket.io/'):
+            self.assertEqual(packing.client_room(), packing.JSON_ROOM)
+
+        # models are only packed when enabled
+        with mock.patch('flack.events.socketio.emit') as emit:
+            push_model(msg)
+            self.assertEqual(emit.call_count, 1)
+            self.assertEqual(emit.call_args[0][1]['model']['html'],
+                             '<em>hello</em>')
+            self.app.config['SOCKETIO_MSGPACK'] = True
+            emit.reset_mock()
+            push_model(msg)
+            json_call, msgpack_call = emit.call_args_list
+            self.assertEqual(json_call[1]['room'], packing.JSON_ROOM)
+            self.assertEqual(json_call[0][1]['class'], 'Message')
+            self.assertEqual(msgpack_call[1]['room'], packing.MSGPACK_ROOM)
+            self.assertEqual(packing.unpack_model(
+                msgpack_call[0][1])['model']['html'], '<em>hello</em>')
+
+    def test_asgi(self):
+        import flack.wsgi_aux  # noqa: it would replace the emitter later
+
+        server = socketio.server
+        asgi = aio.ASGIApp(self.app, threads=2)
+        loop = asyncio.new_event_loop()
+        emitted = []
+
+        async def emit(event, data=None, room=None, **kwargs):
+            emitted.append((event, data))
+        asgi.sio.emit = emit
+
+        async def http(method, path, data=None, headers=None):
+            received = [{'type': 'http.request',
+                         'body': json.dumps(data).encode('utf-8')
+                         if data else b''}]
+            sent = []
+
+            async def receive():
+                return received.pop(0)
+
+            async def send(event):
+                sent.append(event)
+
+            await asgi({
+                'type': 'http', 'method': method, 'path': path,
+                'query_string': b'', 'client': ('127.0.0.1', 12345),
+                'headers': [(b'content-type', b'application/json')] +
+                (headers or [])}, receive, send)
+            return json.loads(b''.join(
+                event.get('body', b'') for event in sent[1:]).decode()), \
+                sent[0]['status']
+
+        try:
+            # HTTP requests are handled by the Flask application
+            r, s = loop.run_until_complete(http(
+                'POST', '/api/users', {'nickname': 'foo', 'password': 'bar'}))
+            self.assertEqual(s, 201)
+            r, s = loop.run_until_complete(http(
+                'POST', '/api/tokens', headers=[
+                    (b'authorization', b'Basic ' + base64.b64encode(
+                        b'foo:bar'))]))
+            self.assertEqual(s, 200)
+            token = r['token']
+
+            # Socket.IO events are handled by the event handlers in events.py
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/socket.io/',
+                       'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+                       'SERVER_PORT': '80', 'REMOTE_ADDR': '127.0.0.1',
+                       'wsgi.url_scheme': 'http'}
+            asgi.sio.environ['abc'] = environ
+            loop.run_until_complete(asgi.on_connect('abc', environ))
+            user = User.query.filter_by(nickname='foo').first()
+            user.online = False
+            db.session.commit()
+            del emitted[:]
+            handlers = asgi.sio.handlers['/']
+            loop.run_until_complete(handlers['ping_user']('abc', token))
+            self.assertEqual(asgi.sessions['abc'], {'user_id': 1})
+            self.assertEqual(emitted[0][1]['model']['online'], True)
+            loop.run_until_complete(handlers['post_message'](
+                'abc', {'source': '*hello*'}, token))
+            self.assertEqual(emitted[-1][1]['model']['html'],
+                             '<em>hello</em>')
+            loop.run_until_complete(asgi.on_disconnect('abc'))
+            self.assertNotIn('abc', asgi.sessions)
+            self.assertEqual(emitted[-1][1]['model']['online'], False)
+        finally:
+            loop.close()
+            asgi.executor.shutdown()
+            socketio.server = server
+
+    def test_pubsub(self):
+        path = tempfile.mkdtemp()
+        url = 'unix://' + path
+        listener = pubsub.UnixSocketManager(url, channel='test')
+        emitter = pubsub.UnixSocketManager(url, channel='test',
+                                           write_only=True)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(path, 'test')).st_mode), 0o700)
+
+        # directories that other users own or can write to are rejected
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(RuntimeError):
+                pubsub.UnixSocketManager(url, channel='test')
+        os.chmod(path, 0o777)
+        with self.assertRaises(RuntimeError):
+            pubsub.UnixSocketManager(url, channel='test')
+        os.chmod(path, 0o700)
+        shared = os.path.join(path, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o770)
+        with self.assertRaises(RuntimeError):
+            pubsub.UnixSocketManager(url, channel='shared')
+
+        messages = listener._listen()
+        received = []
+        thread = threading.Thread(
+            target=lambda: received.append(next(messages)))
+        thread.start()
+        try:
+            while listener.address is None or \
+                    not os.path.exists(listener.address):
+                time.sleep(0.01)
+
+            # a socket left behind by a process that ended is removed
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stale.bind(os.path.join(path, 'test', 'stale.sock'))
+            stale.close()
+
+            data = {'method': 'emit', 'event': 'updated_model',
+                    'data': {'class': 'Message'}, 'room': None}
+            emitter._publish(data)
+            thread.join(5)
+            self.assertEqual([pickle.loads(m) for m in received], [data])
+            self.assertEqual(os.listdir(os.path.join(path, 'test')),
+                             [os.path.basename(listener.address)])
+
+            # messages up to the size limit are delivered
+            received = []
+            thread = threading.Thread(
+                target=lambda: received.append(next(messages)))
+            thread.start()
+            data['data']['source'] = 'x' * (pubsub.MAX_MESSAGE_SIZE - 1000)
+            emitter._publish(data)
+            thread.join(5)
+            self.assertEqual([pickle.loads(m) for m in received], [data])
+
+            # messages that do not fit in the send buffer are dropped with
+            # an error, without removing the socket they were sent to
+            emitter.sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                      4096)
+            with self.assertLogs('flack.pubsub', 'ERROR'):
+                emitter._publish(data)
+            self.assertEqual(os.listdir(os.path.join(path, 'test')),
+                             [os.path.basename(listener.address)])
+        finally:
+            messages.close()
+            shutil.rmtree(path)
+
     def test_celery(self):
         # create a user and a token
         r, s, h = self.post('/api/users', data={'nickname': 'foo',
@@ -439,13 +1597,198 @@ class FlackTests(unittest.TestCase):
             environ = m.call_args_list[0][1]['args'][0]
             self.assertEqual(environ['_wsgi.input'], b'{"source": "hello!"}')
 
-        with mock.patch('flack.api.messages.jsonify', side_effect=ValueError):
+        with mock.patch('flack.cache.jsonify_model', side_effect=ValueError):
             r, s, h = self.post(
                 '/api/messages',
                 data={'source': 'hello!'},
                 token_auth=token)
             self.assertEqual(s, 500)
 
+    def test_local_tasks(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+
+        # async routes run in the executor of the server process
+        self.app.config['TASK_BACKEND'] = 'local'
+        self.app.config['TASK_THREADS'] = 1
+        self.app.config['TASK_MAX_QUEUE'] = 1
+        executor = get_executor()
+        with mock.patch('flack.tasks.run_flask_request.apply_async') as m:
+            r, s, h = self.post('/api/messages', data={'source': 'hello!'},
+                                token_auth=token)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(s, 202)
+        executor.queue.join()
+        r, s, h = self.get(h['Location'])
+        self.assertEqual(s, 201)
+        self.assertEqual(r['source'], 'hello!')
+        r, s, h = self.get('/tasks/status/foo')
+        self.assertEqual(s, 404)
+
+        # and so do the messages posted through Socket.IO
+        user = User.query.filter_by(nickname='foo').first()
+        send_messages([(user.id, {'source': 'hi!'}, None)])
+        executor.queue.join()
+        self.assertEqual(Message.query.count(), 2)
+
+        # a full queue makes the server reject async requests
+        started = threading.Event()
+        finish = threading.Event()
+
+        def work():
+            started.set()
+            finish.wait(5)
+            return 'done'
+
+        executor.submit(work)
+        started.wait(5)
+        executor.submit(work)
+        self.assertRaises(QueueFull, executor.submit, work)
+        self.assertEqual(ratelimit.queue_depth(), 1)
+        r, s, h = self.post('/api/messages', data={'source': 'hello!'},
+                            token_auth=token)
+        self.assertEqual(s, 503)
+        self.assertEqual(h['Retry-After'], '1')
+
+        # queued tasks are completed on shutdown
+        finish.set()
+        id = executor.submit(work, block=True, timeout=5)
+        executor.shutdown(timeout=5)
+        self.assertEqual(executor.status(id), ('SUCCESS', 'done'))
+        self.assertRaises(RuntimeError, executor.submit, work)
+
+        # results expire
+        executor = Executor(threads=1, result_ttl=0)
+        id = executor.submit(work)
+        executor.shutdown(timeout=5)
+        executor.last_prune = 0
+        self.assertEqual(executor.status(id), ('PENDING', None))
+
+        # shutting down with a full queue and a stuck task gives up at the
+        # deadline
+        started.clear()
+        finish.clear()
+        executor = Executor(threads=1, max_queue=1)
+        executor.submit(work)
+        started.wait(5)
+        executor.submit(work)
+        start = time.time()
+        with self.assertLogs('flack.executor', 'WARNING'):
+            executor.shutdown(timeout=0.2)
+        self.assertLess(time.time() - start, 2)
+        finish.set()
+
+    def test_object_cache(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/tokens', basic_auth='foo:bar')
+        self.assertEqual(s, 200)
+        token = r['token']
+        r, s, h = self.post('/api/messages', data={'source': 'hello!'},
+                            token_auth=token)
+        self.assertEqual(s, 201)
+        url = h['Location']
+
+        # each version of a message is serialized once for all its readers
+        with mock.patch.object(Message, 'row_to_dict',
+                               wraps=Message.row_to_dict) as m:
+            r, s, h = self.get(url)
+            self.assertEqual(s, 200)
+            self.assertEqual(r['source'], 'hello!')
+            r, s, h = self.get('/api/messages')
+            self.assertEqual(s, 200)
+            self.assertEqual(r['messages'][0]['source'], 'hello!')
+            with mock.patch('flack.events.socketio.emit') as emit:
+                push_model(Message.query.get(1))
+            self.assertEqual(emit.call_args[0][1]['model']['source'],
+                             'hello!')
+            self.assertEqual(m.call_count, 1)
+
+            # changes made through the session drop the entry when they are
+            # flushed
+            msg = Message.query.get(1)
+            msg.source = 'hello *world*!'
+            db.session.flush()
+            self.assertNotIn(('Message', 1),
+                             self.app.extensions['object_cache'].entries)
+            db.session.rollback()
+
+            # the new version broadcast after an edit is shared with readers
+            r, s, h = self.put(url, data={'source': 'hello *world*!'},
+                               token_auth=token)
+            self.assertEqual(s, 204)
+            r, s, h = self.get(url)
+            self.assertEqual(r['source'], 'hello *world*!')
+            self.assertEqual(m.call_count, 2)
+
+            # changes made by other means are detected by the version check,
+            # even when updated_at does not change
+            db.session.execute(Message.__table__.update().values(
+                source='bye!', updated_at=Message.updated_at))
+            db.session.commit()
+            r, s, h = self.get(url)
+            self.assertEqual(r['source'], 'bye!')
+            r, s, h = self.get(url)
+            self.assertEqual(m.call_count, 3)
+
+        # the cache can be disabled
+        self.app.extensions.pop('object_cache')
+        self.app.config['OBJECT_CACHE_SIZE'] = 0
+        r, s, h = self.get(url)
+        self.assertEqual(r['source'], 'bye!')
+        self.assertNotIn('object_cache', self.app.extensions)
+
+    def test_presence(self):
+        user = User(nickname='foo', password='bar', online=True)
+        db.session.add(user)
+        db.session.commit()
+
+        # closing one of several connections leaves the user online
+        with mock.patch('flack.events.push_model') as push:
+            presence.connect(1, 'a')
+            presence.connect(1, 'b')
+            presence.disconnect(1, 'a')
+            self.assertTrue(User.query.get(1).online)
+            self.assertEqual(push.call_count, 0)
+
+            # the last one marks the user offline with a single emit
+            presence.disconnect(1, 'b')
+            self.assertFalse(User.query.get(1).online)
+            self.assertEqual(push.call_count, 1)
+            presence.disconnect(1, 'b')
+            self.assertEqual(push.call_count, 1)
+
+        # connections that are not seen for a while are not counted
+        user = User.query.get(1)
+        user.online = True
+        db.session.commit()
+        self.app.config['PRESENCE_TTL'] = 60
+        presence.connect(1, 'c')
+        with mock.patch('flack.presence.time.time',
+                        return_value=time.time() + 61):
+            presence.connect(1, 'd')
+            presence.disconnect(1, 'd')
+        self.assertFalse(User.query.get(1).online)
+
+        # a connection during the grace period keeps the user online
+        user = User.query.get(1)
+        user.online = True
+        db.session.commit()
+        self.app.config['PRESENCE_GRACE_PERIOD'] = 0.1
+        with mock.patch('threading.Timer') as timer:
+            presence.disconnect(1, 'e')
+            presence.connect(1, 'f')
+            timer.call_args[0][1]()
+            self.assertTrue(User.query.get(1).online)
+            presence.disconnect(1, 'f')
+            timer.call_args[0][1]()
+            self.assertFalse(User.query.get(1).online)
+
     def test_socketio(self):
         client = socketio.test_client(self.app)
 
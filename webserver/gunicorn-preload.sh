@@ -0,0 +1 @@
+venv/bin/gunicorn -c webserver/gunicorn_preload.py flack.wsgi
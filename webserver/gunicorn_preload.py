@@ -0,0 +1,26 @@
+# Gunicorn configuration for preloading the application in the master
+# process. Start the server with:
+#     venv/bin/gunicorn -c webserver/gunicorn_preload.py flack.wsgi
+
+# the application is loaded before the eventlet worker starts, so the
+# standard library has to be patched here, before it is imported
+import eventlet
+eventlet.monkey_patch()
+
+bind = '127.0.0.1:5000'
+preload_app = True
+# Gunicorn gives each request to any of its workers, but Socket.IO needs all
+# the requests of a client to reach the same process, so a single eventlet
+# worker is used. Preloading still builds the shared state before the fork,
+# and restarted workers get it without building it again. For several
+# workers that share memory, use uwsgi-preload.sh, which gives each worker
+# its own port.
+worker_class = 'eventlet'
+workers = 1
+raw_env = ['FLACK_PRELOAD=1']
+
+
+def post_fork(server, worker):
+    from flack import preload
+    from flack.wsgi import app
+    preload.post_fork(app, workers=server.cfg.workers)
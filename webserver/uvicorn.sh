@@ -0,0 +1 @@
+venv/bin/uvicorn --host 127.0.0.1 --port 5000 flack.asgi:app
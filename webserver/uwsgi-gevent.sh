@@ -1 +1 @@
-venv/bin/uwsgi --gevent 100 --http 127.0.0.1:5000 --wsgi-file flack/wsgi.py
+SOCKETIO_ASYNC_MODE=gevent_uwsgi venv/bin/uwsgi --gevent 100 --gevent-monkey-patch --http 127.0.0.1:5000 --wsgi-file flack/wsgi.py
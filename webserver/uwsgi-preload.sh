@@ -0,0 +1,11 @@
+# The master process loads the application and forks four gevent workers.
+# Socket.IO needs all the requests of a client to reach the same process, so
+# each worker gets its own port instead of sharing one, and nginx assigns
+# clients to ports with sticky sessions (see nginx/flack.conf).
+FLACK_PRELOAD=1 SOCKETIO_ASYNC_MODE=gevent_uwsgi venv/bin/uwsgi --master \
+    --processes 4 --gevent 100 --gevent-monkey-patch \
+    --shared-socket 127.0.0.1:5000 --shared-socket 127.0.0.1:5001 \
+    --shared-socket 127.0.0.1:5002 --shared-socket 127.0.0.1:5003 \
+    --http-socket =0 --http-socket =1 --http-socket =2 --http-socket =3 \
+    --map-socket 0:1 --map-socket 1:2 --map-socket 2:3 --map-socket 3:4 \
+    --wsgi-file flack/wsgi.py